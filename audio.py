@@ -0,0 +1,112 @@
+import audioop
+import io
+import struct
+import wave
+import discord
+from typing import Union
+
+
+#discordに渡す音声は48kHz・16bit・ステレオを20msごと
+SAMPLING_RATE = discord.opus.Encoder.SAMPLING_RATE
+SAMPLE_WIDTH = 2
+MONO_FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE // discord.opus.Encoder.CHANNELS
+#encode_opusで符号化した音声の先頭に付ける印．これがなければPCMとして扱う
+OPUS_MAGIC = b'SBOPUS01'
+PACKET_LENGTH = struct.Struct('>H')
+
+
+def decode_wav(data:bytes) -> bytes:
+    """wavファイルの中身を48kHz・16bit・モノラルのPCMに変換する．"""
+    with wave.open(io.BytesIO(data), 'rb') as wav:
+        n_channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        pcm = wav.readframes(wav.getnframes())
+    if width != SAMPLE_WIDTH:
+        pcm = audioop.lin2lin(pcm, width, SAMPLE_WIDTH)
+    if n_channels == 2:
+        pcm = audioop.tomono(pcm, SAMPLE_WIDTH, 0.5, 0.5)
+    if rate != SAMPLING_RATE:
+        pcm, _ = audioop.ratecv(pcm, SAMPLE_WIDTH, 1, rate, SAMPLING_RATE, None)
+    return pcm
+
+
+def load_wav(path:str) -> bytes:
+    with open(path, 'rb') as f:
+        return decode_wav(f.read())
+
+
+class PCMAudio(discord.AudioSource):
+    """モノラルのPCMをステレオに広げながら20msずつ返す音源．ffmpegを使わずに再生できる．
+
+    渡されたバッファは複製せずにmemoryviewで読むので，効果音のような共有バッファもそのまま渡せる．
+    """
+    def __init__(self, pcm:bytes) -> None:
+        self.pcm = memoryview(pcm)
+        self.pos = 0
+
+
+    def read(self) -> bytes:
+        frame = self.pcm[self.pos:self.pos + MONO_FRAME_SIZE]
+        self.pos += MONO_FRAME_SIZE
+        if len(frame) == 0:
+            return b''
+        #最後のフレームは無音で埋める
+        if len(frame) < MONO_FRAME_SIZE:
+            frame = bytes(frame) + bytes(MONO_FRAME_SIZE - len(frame))
+        return audioop.tostereo(frame, SAMPLE_WIDTH, 1, 1)
+
+
+def opus_available() -> bool:
+    #libopusが読み込めなければ符号化は音声スレッドに任せる
+    try:
+        discord.opus.Encoder()
+    except discord.opus.OpusNotLoaded:
+        return False
+    return True
+
+
+def encode_opus(pcm:bytes) -> bytes:
+    """モノラルのPCMを20msごとのOpusパケットに符号化し，長さ(2バイト)を前に付けて1つのbytesにまとめる．
+
+    libopusの呼び出し中はGILを手放すので，スレッドで実行すれば他の処理を止めない．
+    """
+    encoder = discord.opus.Encoder()
+    pcm = memoryview(pcm)
+    chunks = [OPUS_MAGIC]
+    for pos in range(0, len(pcm), MONO_FRAME_SIZE):
+        frame = pcm[pos:pos + MONO_FRAME_SIZE]
+        if len(frame) < MONO_FRAME_SIZE:
+            frame = bytes(frame) + bytes(MONO_FRAME_SIZE - len(frame))
+        packet = encoder.encode(audioop.tostereo(frame, SAMPLE_WIDTH, 1, 1), encoder.SAMPLES_PER_FRAME)
+        chunks.append(PACKET_LENGTH.pack(len(packet)))
+        chunks.append(packet)
+    return b''.join(chunks)
+
+
+def is_opus(data:bytes) -> bool:
+    return data[:len(OPUS_MAGIC)] == OPUS_MAGIC
+
+
+class OpusAudio(discord.AudioSource):
+    """encode_opusで符号化済みのパケットを1つずつ返す音源．音声スレッドでの符号化を省ける．"""
+    def __init__(self, data:bytes) -> None:
+        self.data = memoryview(data)
+        self.pos = len(OPUS_MAGIC)
+
+
+    def read(self) -> bytes:
+        if self.pos >= len(self.data):
+            return b''
+        length, = PACKET_LENGTH.unpack_from(self.data, self.pos)
+        self.pos += PACKET_LENGTH.size + length
+        return bytes(self.data[self.pos - length:self.pos])
+
+
+    def is_opus(self) -> bool:
+        return True
+
+
+def audio_source(data:bytes) -> Union[PCMAudio, OpusAudio]:
+    """合成結果やキャッシュの中身に合わせて音源を作る．符号化前のPCMもそのまま再生できる．"""
+    return OpusAudio(data) if is_opus(data) else PCMAudio(data)
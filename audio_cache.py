@@ -0,0 +1,201 @@
+import asyncio
+import os
+import hashlib
+from collections import OrderedDict
+from typing import List, Union
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+class AudioCache:
+    """合成済み音声のキャッシュ．
+
+    テキストとボイス設定から作ったハッシュをキーに，メモリ上とディスク上(任意)の2段で保持する．
+    どちらもバイト数の上限を超えたら最も長く使われていないものから捨てる．
+    メモリ上はgetで同期的に引き，ディスクの読み書きはイベントループを止めないようにスレッドで行う．
+    """
+    def __init__(self, max_bytes:int=64 * 2**20, disk_dir:str=None, max_disk_bytes:int=512 * 2**20) -> None:
+        self.body = OrderedDict()
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.disk_dir = disk_dir
+        self.disk_index = OrderedDict()
+        self.max_disk_bytes = max_disk_bytes
+        self.n_disk_bytes = 0
+        #書き込み中のキーと，まだ終わっていないディスク操作
+        self.writing = set()
+        self.pending = set()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.load_disk_index()
+
+
+    @staticmethod
+    def key(text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> str:
+        src = '\0'.join([text.strip(), speaker, emotion, effect, str(int(tone)), str(int(speed))])
+        return hashlib.sha256(src.encode()).hexdigest()
+
+
+    @staticmethod
+    def base_key(text:str, speaker:str='mei', emotion:str='normal', tone:str='0') -> str:
+        #後処理(dsp.py)の元にする，スピードとエフェクトを付ける前のPCM
+        src = '\0'.join(['base', text.strip(), speaker, emotion, str(int(tone))])
+        return hashlib.sha256(src.encode()).hexdigest()
+
+
+    def load_disk_index(self) -> None:
+        #前回までのファイルを古い順に登録する
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith('.bin'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len('.bin')], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk_index[key] = size
+            self.n_disk_bytes += size
+        self.evict_disk()
+        logger.info(f'ディスクキャッシュを読み込みました．({len(self.disk_index)}件, {self.n_disk_bytes // 2**20}MB)')
+
+
+    def disk_path(self, key:str) -> str:
+        return f'{self.disk_dir}/{key}.bin'
+
+
+    def get(self, key:str) -> Union[bytes, None]:
+        """メモリ上だけを引く．"""
+        if key in self.body:
+            self.body.move_to_end(key)
+            self.hits += 1
+            return self.body[key]
+        return None
+
+
+    async def load(self, key:str) -> Union[bytes, None]:
+        """メモリ上になければディスクから読む．"""
+        if (data := self.get(key)) is not None:
+            return data
+        if key in self.disk_index:
+            data = await self.run(self.read_disk, key)
+            if data is None:
+                self.n_disk_bytes -= self.disk_index.pop(key, 0)
+            else:
+                if key in self.disk_index:
+                    self.disk_index.move_to_end(key)
+                self.disk_hits += 1
+                self.put_memory(key, data)
+                return data
+        self.misses += 1
+        return None
+
+
+    def read_disk(self, key:str) -> Union[bytes, None]:
+        #スレッドで実行する
+        try:
+            with open(self.disk_path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.disk_path(key))
+            return data
+        except OSError:
+            return None
+
+
+    def write_disk(self, key:str, data:bytes) -> None:
+        #スレッドで実行する．書きかけのファイルを読まないように名前を変えて置き換える
+        tmp = f'{self.disk_path(key)}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.disk_path(key))
+
+
+    def put(self, key:str, data:bytes) -> None:
+        """メモリ上にはすぐ入れ，ディスクへは後で書き込む．"""
+        self.put_memory(key, data)
+        if (self.disk_dir is not None) and (key not in self.disk_index) and (key not in self.writing) and (len(data) <= self.max_disk_bytes):
+            self.writing.add(key)
+            future = self.run(self.write_disk, key, data)
+            future.add_done_callback(lambda future: self.on_written(key, len(data), future))
+
+
+    def on_written(self, key:str, size:int, future:asyncio.Future) -> None:
+        self.writing.discard(key)
+        if future.cancelled():
+            return
+        if (error := future.exception()) is not None:
+            logger.error(f'{error.__class__.__name__}: {error}')
+            return
+        self.disk_index[key] = size
+        self.n_disk_bytes += size
+        self.evict_disk()
+
+
+    def run(self, func, *args) -> asyncio.Future:
+        future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+
+    def put_memory(self, key:str, data:bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        if key in self.body:
+            self.n_bytes -= len(self.body.pop(key))
+        self.body[key] = data
+        self.n_bytes += len(data)
+        while self.n_bytes > self.max_bytes:
+            _, old = self.body.popitem(last=False)
+            self.n_bytes -= len(old)
+
+
+    def evict_disk(self) -> None:
+        paths = []
+        while self.n_disk_bytes > self.max_disk_bytes:
+            key, size = self.disk_index.popitem(last=False)
+            self.n_disk_bytes -= size
+            paths.append(self.disk_path(key))
+        if paths:
+            #起動時(load_disk_index)はイベントループの外なのでその場で消す
+            try:
+                self.run(self.remove_files, paths)
+            except RuntimeError:
+                self.remove_files(paths)
+
+
+    @staticmethod
+    def remove_files(paths:List[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    async def close(self) -> None:
+        #書き込み途中のものを待つ
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self.body),
+            'bytes': self.n_bytes,
+            'disk_entries': len(self.disk_index),
+            'disk_bytes': self.n_disk_bytes
+        }
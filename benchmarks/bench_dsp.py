@@ -0,0 +1,82 @@
+"""後処理(dsp.py)でスピードとエフェクトを付けた音声を，open_jtalkに直接渡して合成した音声と比べる．
+
+比べるのは長さの比，音量の差(dB)，長時間平均スペクトルの差(dB，8kHzまで)と処理時間．
+./openjtalkに本物のopen_jtalkと音響モデルがあればそちらで，なければbenchmarks/stub_openjtalkで測る
+(偽のopen_jtalkは無音を返すので，処理時間だけを見る)．NumPyがなければ何もしない．
+
+    python benchmarks/bench_dsp.py
+"""
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import dsp
+from audio import SAMPLING_RATE
+from tts import TTS
+from bench_tts import STUB_DIR, REAL_DIR, real_available
+
+
+TEXTS = ['こんにちは．', '今日はいい天気ですね．', 'ちょっと長めの文章を読み上げるときにどれくらい時間がかかるのかを測ります．']
+VARIANTS = [('none', '-3'), ('none', '-1'), ('none', '+2'), ('none', '+5'), ('robot', '0'), ('whisper', '0'), ('whisper', '+2')]
+
+
+def spectrum_db(x) -> 'dsp.np.ndarray':
+    np = dsp.np
+    size = 1024
+    power = np.mean(np.square(np.abs(dsp.stft(x, size, size // 4))), axis=0)
+    return 10 * np.log10(power[:size * 8000 // SAMPLING_RATE] + 1e-10)
+
+
+def compare(native:bytes, processed:bytes) -> dict:
+    np = dsp.np
+    x, y = dsp.to_array(native), dsp.to_array(processed)
+    result = {'duration_ratio': len(y) / len(x) if len(x) else None}
+    if (dsp.rms(x) > 0) and (dsp.rms(y) > 0):
+        result['level_db'] = 20 * np.log10(dsp.rms(y) / dsp.rms(x))
+        #音量の差を除いたスペクトルの形の違い
+        diff = spectrum_db(y) - spectrum_db(x)
+        result['spectral_distance_db'] = float(np.sqrt(np.mean(np.square(diff - np.mean(diff)))))
+    return result
+
+
+def bench_binary(openjtalk_dir:str, number:int) -> dict:
+    tts = TTS(openjtalk_dir)
+    results = {}
+    for effect, speed in VARIANTS:
+        native_sec = dsp_sec = 0.0
+        quality = []
+        for _ in range(number):
+            for text in TEXTS:
+                start = time.perf_counter()
+                native = tts.synthesize(text, effect=effect, speed=speed)
+                native_sec += time.perf_counter() - start
+                #基準の合成は使い回せるので後処理の時間だけを数える
+                base = tts.synthesize(text, *dsp.base_voice(effect=effect, speed=speed))
+                start = time.perf_counter()
+                processed = dsp.process(base, speed, effect)
+                dsp_sec += time.perf_counter() - start
+                quality.append(compare(native, processed))
+        n = number * len(TEXTS)
+        results[f'{effect}_{speed}'] = {
+            'native_msec_per_text': native_sec / n * 1e3,
+            'dsp_msec_per_text': dsp_sec / n * 1e3,
+            **{key: sum(q[key] for q in quality) / len(quality) for key in quality[0] if all(q.get(key) is not None for q in quality)}
+        }
+    return results
+
+
+def bench(number:int=3) -> dict:
+    if not dsp.available():
+        return {'skipped': 'NumPyがありません．'}
+    results = {'stub': bench_binary(STUB_DIR, number)}
+    if real_available():
+        results['open_jtalk'] = bench_binary(REAL_DIR, number)
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), ensure_ascii=False, indent=2))
@@ -0,0 +1,56 @@
+"""設定キャッシュ(postgres.LRUCache)のget/putの処理時間を，ヒット率を変えて測る．
+
+fetchと同じく，getで外れたらputする．
+
+    python benchmarks/bench_lru.py
+"""
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from postgres import LRUCache, logger
+from utils import random_voice
+
+
+def bench_mix(size:int, hit_ratio:float, n_ops:int, seed:int=0) -> dict:
+    rng = random.Random(seed)
+    cache = LRUCache('ベンチマーク', size)
+    for i in range(size):
+        cache.put(str(i), random_voice())
+    cache.hits = cache.misses = cache.evictions = 0
+    #hit_ratioの割合でキャッシュ内のキーを，残りは初めてのキーを引く
+    keys = [str(rng.randrange(size)) if rng.random() < hit_ratio else str(size + i) for i in range(n_ops)]
+    conf = random_voice()
+    start = time.perf_counter()
+    for key in keys:
+        if cache.get(key) is None:
+            cache.put(key, conf)
+    elapsed = time.perf_counter() - start
+    return {
+        'size': size,
+        'target_hit_ratio': hit_ratio,
+        #初めてのキーをputすると古いキーが追い出されるので，実際のヒット率は目標より下がる
+        'hit_ratio': cache.hits / n_ops,
+        'usec_per_op': elapsed / n_ops * 1e6,
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'evictions': cache.evictions
+    }
+
+
+def bench(n_ops:int=200000) -> dict:
+    #満杯の警告やputごとのログは測定から外す
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        return {f'size{size}_hit{int(hit_ratio * 100)}': bench_mix(size, hit_ratio, n_ops) for size in [100, 10000] for hit_ratio in [0.5, 0.9, 0.99]}
+    finally:
+        logger.setLevel(level)
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), ensure_ascii=False, indent=2))
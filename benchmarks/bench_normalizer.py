@@ -0,0 +1,66 @@
+"""my_normalizerを元の手順(reference_normalizer)と比較し，1メッセージあたりの処理時間を測る．
+
+    python benchmarks/bench_normalizer.py
+"""
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import my_normalizer, reference_normalizer
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt')
+
+#合成や並べ替えが起きやすい文字を多めに混ぜる
+ALPHABET = (
+    'abcxyzABCXYZ019 !?~-¥\\'
+    'あかがぱアカガパ〜～―－ー'
+    'ｱｶｶﾞﾊﾟｳﾞﾞﾟｰ'
+    '゙゚゛゜'
+    '̧̣́̈⃝'
+    'eEoOuUßǰﬁ①㍿'
+    '각가각'
+    '😀👍🏻'
+)
+
+
+def load_corpus() -> list:
+    with open(CORPUS, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def verify(n_random:int=200000, seed:int=0) -> dict:
+    mismatches = []
+    #1文字ずつ（サロゲートを除く全コードポイント）
+    for cp in range(sys.maxunicode + 1):
+        if 0xD800 <= cp <= 0xDFFF:
+            continue
+        c = chr(cp)
+        if my_normalizer(c) != reference_normalizer(c):
+            mismatches.append(c)
+    #ランダムな文字列とコーパス
+    rng = random.Random(seed)
+    samples = load_corpus()
+    samples += [''.join(rng.choices(ALPHABET, k=rng.randint(1, 30))) for _ in range(n_random)]
+    for text in samples:
+        if my_normalizer(text) != reference_normalizer(text):
+            mismatches.append(text)
+    return {'checked': sys.maxunicode + 1 - 0x800 + len(samples), 'mismatches': [ascii(m) for m in mismatches[:20]], 'n_mismatches': len(mismatches)}
+
+
+def bench(number:int=2000) -> dict:
+    corpus = load_corpus()
+    my_normalizer(''.join(corpus))
+    results = {}
+    for name, func in [('reference_normalizer', reference_normalizer), ('my_normalizer', my_normalizer)]:
+        sec = min(timeit.repeat(lambda: [func(text) for text in corpus], number=number, repeat=3))
+        results[name] = {'usec_per_message': sec / number / len(corpus) * 1e6}
+    results['speedup'] = results['reference_normalizer']['usec_per_message'] / results['my_normalizer']['usec_per_message']
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps({'verify': verify(), 'bench': bench()}, ensure_ascii=False, indent=2))
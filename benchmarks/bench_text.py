@@ -0,0 +1,78 @@
+"""on_messageでのテキスト処理(modify_text→my_normalizer→truncate_text→split_sentences)の1メッセージあたりの処理時間を測る．
+
+Discordには繋がず，benchmarks/fakes.pyの偽のメッセージとサーバーを使う．
+
+    python benchmarks/bench_text.py
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from utils import GuildConf, modify_text, my_normalizer, truncate_text, split_sentences, mention_cache
+from fakes import FakeBot, FakeGuild, make_messages
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt')
+
+
+def load_corpus() -> list:
+    with open(CORPUS, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+async def time_async(func, items:list, number:int) -> float:
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(number):
+            for item in items:
+                await func(item)
+        best = min(best, time.perf_counter() - start)
+    return best / number / len(items) * 1e6
+
+
+def time_sync(func, items:list, number:int) -> float:
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(number):
+            for item in items:
+                func(item)
+        best = min(best, time.perf_counter() - start)
+    return best / number / len(items) * 1e6
+
+
+async def bench_async(number:int) -> dict:
+    guild = FakeGuild(1)
+    bot = FakeBot()
+    messages = make_messages(load_corpus(), guild)
+    guild_conf = GuildConf(read_author=True)
+    mention_cache.body.clear()
+
+    async def pipeline(message) -> None:
+        text = my_normalizer(await modify_text(message, guild_conf, bot))
+        split_sentences(truncate_text(text, guild_conf.max_chars))
+
+    modified = [await modify_text(message, guild_conf, bot) for message in messages]
+    normalized = [my_normalizer(text) for text in modified]
+    return {
+        'modify_text': {'usec_per_message': await time_async(lambda message: modify_text(message, guild_conf, bot), messages, number)},
+        'my_normalizer': {'usec_per_message': time_sync(my_normalizer, modified, number)},
+        'truncate_split': {'usec_per_message': time_sync(lambda text: split_sentences(truncate_text(text, guild_conf.max_chars)), normalized, number)},
+        'pipeline': {'usec_per_message': await time_async(pipeline, messages, number)},
+        'n_messages': len(messages),
+        #TTLキャッシュが効いていればAPIは各idにつき1回しか呼ばれない
+        'api_fetches': bot.n_fetches
+    }
+
+
+def bench(number:int=200) -> dict:
+    return asyncio.run(bench_async(number))
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), ensure_ascii=False, indent=2))
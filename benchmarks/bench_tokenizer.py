@@ -0,0 +1,74 @@
+"""modify_textの特殊パターン・絵文字・URL・笑いの置換を，以前の4段の処理と比較して1メッセージあたりの処理時間を測る．
+
+    python benchmarks/bench_tokenizer.py
+"""
+import json
+import os
+import random
+import re
+import sys
+import timeit
+
+import demoji
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import replace_tokens
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.txt')
+
+special_pattern = re.compile(r'<.*>')
+url_pattern = re.compile(r'https?://[\w/:%#\$&\?\(\)~\.=\+\-]+')
+www_pattern = re.compile(r'(w+|W+|ｗ+|Ｗ+|笑+|\(笑\)|（笑）)$')
+
+#絵文字の連続で正規表現のバックトラックが指数的に増えていた入力．1件でも数秒かかっていた
+PATHOLOGICAL = ['笑' + '😂' * 20 + 'まじで', 'w' + '😀' * 22 + 'a', 'ｗ' + '<:a:1>😀' * 30 + 'x', 'https://a.jp/' + '😀' * 30 + ' w' + '😀' * 30 + '.']
+
+PIECES = ['あいう', 'カタカナ', 'www', 'w', 'ｗｗ', '笑', '(笑)', ' ', '，', 'https://example.com/a?b=1', 'http://x.jp',
+          '<:pepe:1>', '<a:dance:2>', '😀', '👍🏻', '👨‍👩‍👧', '🇯🇵', '1️⃣', '©', '❤️', 'ok', '。', '<', '>',
+          #単独では絵文字ではない部品(ZWJ，異体字セレクタ，キーキャップ，国旗の片割れ，タグ，肌の色)と，部品とつながりうる文字
+          '\u200d', '\ufe0f', '\u20e3', '🇯', '🇵', '🏴', '\U000e0067', '\U000e0062', '\U000e007f', '🏻', '™', '*', '#', '1', 'W']
+
+
+def reference_chain(text:str) -> str:
+    text = special_pattern.sub('', text)
+    text = demoji.replace(text, '')
+    text = url_pattern.sub('，URL，', text)
+    text = www_pattern.sub('，藁．', text)
+    return text
+
+
+def tokenize(text:str) -> str:
+    return replace_tokens(text)
+
+
+def load_corpus() -> list:
+    with open(CORPUS, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def verify(n_random:int=50000, seed:int=0) -> dict:
+    rng = random.Random(seed)
+    samples = load_corpus() + PATHOLOGICAL + [''.join(rng.choices(PIECES, k=rng.randint(1, 8))) for _ in range(n_random)]
+    mismatches = [text for text in samples if tokenize(text) != reference_chain(text)]
+    return {'checked': len(samples), 'n_mismatches': len(mismatches), 'mismatches': [
+        {'text': text, 'reference': reference_chain(text), 'tokenizer': tokenize(text)} for text in mismatches[:10]
+    ]}
+
+
+def bench(number:int=200) -> dict:
+    corpus = load_corpus()
+    reference_chain('')
+    results = {}
+    for name, func in [('reference_chain', reference_chain), ('token_pattern', tokenize)]:
+        sec = min(timeit.repeat(lambda: [func(text) for text in corpus], number=number, repeat=3))
+        results[name] = {'usec_per_message': sec / number / len(corpus) * 1e6}
+    results['speedup'] = results['reference_chain']['usec_per_message'] / results['token_pattern']['usec_per_message']
+    #最悪の入力でも1件あたりの時間が伸びないことを確かめる
+    sec = min(timeit.repeat(lambda: [tokenize(text) for text in PATHOLOGICAL], number=number, repeat=3))
+    results['pathological'] = {'usec_per_message': sec / number / len(PATHOLOGICAL) * 1e6}
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps({'verify': verify(), 'bench': bench()}, ensure_ascii=False, indent=2))
@@ -0,0 +1,75 @@
+"""TTS.synthesize(毎回open_jtalkを起動)とワーカープール経由の合成(TTS.render)の処理時間を測る．
+
+benchmarks/stub_openjtalkの偽のopen_jtalkで起動や受け渡しの分だけを測り，
+./openjtalkに本物のopen_jtalkと音響モデルがあればそちらでも測る．
+
+    python benchmarks/bench_tts.py
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from tts import TTS, logger
+
+
+STUB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_openjtalk')
+REAL_DIR = os.path.join(ROOT, 'openjtalk')
+TEXTS = ['こんにちは．', '今日はいい天気ですね．', 'ちょっと長めの文章を読み上げるときにどれくらい時間がかかるのかを測ります．']
+
+
+def real_available() -> bool:
+    return os.access(os.path.join(REAL_DIR, 'open_jtalk'), os.X_OK) and os.path.exists(os.path.join(REAL_DIR, 'htsvoice', 'mei', 'normal.htsvoice'))
+
+
+def bench_sync(tts:TTS, number:int) -> dict:
+    start = time.perf_counter()
+    for _ in range(number):
+        for text in TEXTS:
+            tts.synthesize(text)
+    return {'msec_per_text': (time.perf_counter() - start) / number / len(TEXTS) * 1e3}
+
+
+async def bench_pool(tts:TTS, number:int) -> dict:
+    #最初の1回で予備プロセスを用意させる
+    await tts.render(TEXTS[0])
+    results = {}
+    #1件ずつ(先読みなし)と，まとめて投げたとき(複数サーバーで同時に読み上げ)
+    start = time.perf_counter()
+    for _ in range(number):
+        for text in TEXTS:
+            await tts.render(text)
+    results['sequential'] = {'msec_per_text': (time.perf_counter() - start) / number / len(TEXTS) * 1e3}
+    start = time.perf_counter()
+    await asyncio.gather(*[tts.render(text) for _ in range(number) for text in TEXTS])
+    results['concurrent'] = {'msec_per_text': (time.perf_counter() - start) / number / len(TEXTS) * 1e3, 'workers': tts.concurrency}
+    results['pool'] = tts.pool.stats()
+    return results
+
+
+async def bench_binary(openjtalk_dir:str, number:int) -> dict:
+    tts = TTS(openjtalk_dir)
+    try:
+        return {'synthesize': bench_sync(tts, number), 'render': await bench_pool(tts, number)}
+    finally:
+        await tts.close()
+
+
+def bench(number:int=10) -> dict:
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        results = {'stub': asyncio.run(bench_binary(STUB_DIR, number))}
+        if real_available():
+            results['open_jtalk'] = asyncio.run(bench_binary(REAL_DIR, number))
+        return results
+    finally:
+        logger.setLevel(level)
+
+
+if __name__ == '__main__':
+    print(json.dumps(bench(), ensure_ascii=False, indent=2))
@@ -0,0 +1,90 @@
+"""Discordに繋がずにmodify_textなどを動かすための偽物．必要な属性とメソッドだけを持つ．"""
+import random
+import re
+from typing import List
+
+import discord
+
+
+class FakeUser:
+    def __init__(self, id:int, display_name:str, bot:bool=False) -> None:
+        self.id = id
+        self.name = display_name
+        self.display_name = display_name
+        self.bot = bot
+
+
+class FakeNamed:
+    def __init__(self, id:int, name:str) -> None:
+        self.id = id
+        self.name = name
+
+
+class FakeGuild:
+    def __init__(self, id:int, n_members:int=200, n_roles:int=20, n_channels:int=30) -> None:
+        self.id = id
+        self.name = f'guild{id}'
+        self.members = {10**17 + i: FakeUser(10**17 + i, f'user{i}') for i in range(n_members)}
+        self.roles = {2 * 10**17 + i: FakeNamed(2 * 10**17 + i, f'ロール{i}') for i in range(n_roles)}
+        self.channels = {3 * 10**17 + i: FakeNamed(3 * 10**17 + i, f'雑談{i}') for i in range(n_channels)}
+
+    def get_member(self, id:int):
+        return self.members.get(id)
+
+    def get_role(self, id:int):
+        return self.roles.get(id)
+
+    def get_channel(self, id:int):
+        return self.channels.get(id)
+
+
+class FakeBot:
+    """ゲートウェイのキャッシュにないものはAPIを呼ぶ代わりにNotFoundにする．"""
+    def __init__(self) -> None:
+        self.n_fetches = 0
+
+    def get_channel(self, id:int):
+        return None
+
+    async def fetch_channel(self, id:int):
+        self.n_fetches += 1
+        raise discord.NotFound(FakeResponse(), 'Unknown Channel')
+
+    async def fetch_user(self, id:int):
+        self.n_fetches += 1
+        raise discord.NotFound(FakeResponse(), 'Unknown User')
+
+
+class FakeResponse:
+    status = 404
+    reason = 'Not Found'
+
+
+class FakeMessage:
+    def __init__(self, content:str, guild:FakeGuild, author:FakeUser, mentions:List[FakeUser]) -> None:
+        self.content = content
+        self.guild = guild
+        self.author = author
+        self.mentions = mentions
+
+
+mention_pattern = re.compile(r'<@!?(\d+)>')
+
+
+def make_messages(lines:List[str], guild:FakeGuild, seed:int=0) -> List[FakeMessage]:
+    """コーパスの各行を送信者とメンション先を決めたメッセージにする．
+
+    コーパス内のメンションのidはサーバーのメンバー・ロール・チャンネルのidに付け替える．
+    """
+    rng = random.Random(seed)
+    members = list(guild.members.values())
+    roles = list(guild.roles)
+    channels = list(guild.channels)
+    messages = []
+    for line in lines:
+        line = re.sub(r'<@!?\d+>', lambda _: f'<@!{rng.choice(members).id}>', line)
+        line = re.sub(r'<@&\d+>', lambda _: f'<@&{rng.choice(roles)}>', line)
+        line = re.sub(r'<#\d+>', lambda _: f'<#{rng.choice(channels)}>', line)
+        mentions = [guild.members[int(id)] for id in mention_pattern.findall(line)]
+        messages.append(FakeMessage(line, guild, rng.choice(members), mentions))
+    return messages
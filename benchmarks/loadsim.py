@@ -0,0 +1,438 @@
+"""多数のサーバーからの読み上げを想定して，discordbot.pyのon_messageとon_voice_state_updateを直接呼ぶ負荷試験．
+
+Discordには繋がず，ゲートウェイのイベントは偽のサーバー・ユーザー・VoiceClientで作る．
+Postgresはメモリ上のMemoryPostgres(キャッシュや同時読み込みのまとめはPostgresのものをそのまま使う)，
+open_jtalkはbenchmarks/stub_openjtalk(--openjtalkで本物も指定可)を使い，VoiceClientは音声を実時間で読み進める．
+
+    python benchmarks/loadsim.py --guilds 200 --rate 0.2 --duration 60
+    python benchmarks/loadsim.py --save-trace trace.jsonl      #生成したイベントを保存
+    python benchmarks/loadsim.py --trace trace.jsonl           #保存・記録したイベントを再生
+
+トレースは1行1イベントのJSONで，idは匿名化した任意の整数でよい．
+    {"t": 0.52, "type": "message", "guild": 3, "user": 17, "content": "こんにちは"}
+    {"t": 1.30, "type": "voice", "guild": 3, "user": 21, "action": "join"}    #actionはjoinかleave
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Union
+
+import discord
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+#discordbot.pyの読み込み時に必要な設定
+os.environ.setdefault('TOKEN', 'loadsim')
+os.environ.setdefault('DATABASE_URL', 'postgres://loadsim')
+os.environ.setdefault('PG_LISTEN', 'false')
+os.chdir(ROOT)
+
+import discordbot
+from metrics import metrics
+from postgres import Postgres, CONF_TYPE
+from scheduler import SynthesisScheduler
+from tts import TTS
+from utils import UserConf, GuildConf, random_voice
+
+
+STUB_DIR = os.path.join(ROOT, 'benchmarks', 'stub_openjtalk')
+CORPUS = os.path.join(ROOT, 'benchmarks', 'corpus.txt')
+FRAME_SEC = 0.02
+
+
+class MemoryPostgres(Postgres):
+    """Postgresの代わりにメモリ上の辞書に設定を持つ．DBへの問い合わせの部分だけを置き換え，latency秒待たせる．"""
+    def __init__(self, latency:float=0.002, **kwargs) -> None:
+        super().__init__('memory://', listen=False, **kwargs)
+        self.latency = latency
+        self.tables: Dict[str, dict] = {'user': {}, 'guild': {}}
+        self.n_queries = 0
+
+    async def query(self) -> None:
+        self.n_queries += 1
+        await asyncio.sleep(self.latency)
+
+    async def connect(self) -> None:
+        if self.write_behind > 0:
+            self.flusher = asyncio.create_task(self.flush_loop())
+
+    async def create_record(self, obj:Union[discord.Member, discord.Guild]) -> Union[UserConf, GuildConf]:
+        mode = 'user' if isinstance(obj, discord.Member) else 'guild'
+        await self.query()
+        id = str(obj.id)
+        if id not in self.tables[mode]:
+            self.tables[mode][id] = random_voice() if mode == 'user' else self.get_default('guild')
+        return self.tables[mode][id]
+
+    async def set(self, obj:Union[discord.Member, discord.Guild], conf) -> None:
+        mode = 'user' if isinstance(obj, discord.Member) else 'guild'
+        if self.write_behind > 0:
+            await super().set(obj, conf)
+            return
+        await self.query()
+        self.tables[mode][str(obj.id)] = conf
+        self.cache[mode].put(str(obj.id), conf)
+
+    async def flush(self) -> None:
+        for mode in ['user', 'guild']:
+            dirty, self.dirty[mode] = self.dirty[mode], {}
+            if dirty:
+                await self.query()
+            for id, (_, conf) in dirty.items():
+                self.tables[mode][id] = conf
+
+    async def preload(self, mode:str, ids:List[int], chunk_size:int=1000) -> int:
+        await self.query()
+        return 0
+
+    async def fetchall_targetch(self) -> dict:
+        await self.query()
+        return {id: conf.target_ch for id, conf in self.tables['guild'].items()}
+
+    async def disconnect(self) -> None:
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.flush()
+
+
+class SimChannel:
+    def __init__(self, id:int, guild:'SimGuild', name:str) -> None:
+        self.id = id
+        self.guild = guild
+        self.name = name
+        self.members = []
+
+    async def connect(self) -> 'SimVoiceClient':
+        self.guild.sim_voice_client = SimVoiceClient(self)
+        self.members.append(self.guild.sim_bot)
+        return self.guild.sim_voice_client
+
+
+class SimVoiceClient:
+    """渡された音源を20msごとに実時間で読み進めるVoiceClient．"""
+    def __init__(self, channel:SimChannel) -> None:
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self.task = None
+        self.n_frames = 0
+
+    def is_playing(self) -> bool:
+        return self.source is not None
+
+    def play(self, source:discord.AudioSource, *, after=None) -> None:
+        if self.source is not None:
+            raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self.task = asyncio.create_task(self.run(after))
+
+    async def run(self, after) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while self.source.read():
+            self.n_frames += 1
+            deadline += FRAME_SEC
+            await asyncio.sleep(max(deadline - loop.time(), 0))
+        self.source = None
+        if after is not None:
+            after(None)
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        self.source = None
+
+    async def disconnect(self, *, force:bool=False) -> None:
+        self.stop()
+        self.channel.members.remove(self.guild.sim_bot)
+        self.guild.sim_voice_client = None
+
+
+class SimMember(discord.Member):
+    def __init__(self, id:int, name:str, guild:'SimGuild', bot:bool=False) -> None:
+        self._user = SimpleNamespace(id=id, name=name, bot=bot, discriminator='0000')
+        self.nick = None
+        self.guild = guild
+        self.sim_voice = None
+
+    @property
+    def voice(self) -> SimpleNamespace:
+        return self.sim_voice
+
+
+class SimGuild(discord.Guild):
+    def __init__(self, id:int, n_members:int, bot_user:SimpleNamespace) -> None:
+        self.id = id
+        self.name = f'guild{id}'
+        self.sim_voice_client = None
+        self.sim_bot = SimMember(bot_user.id, bot_user.name, self, bot=True)
+        self.text_channel = SimChannel(id * 10 + 1, self, '雑談')
+        self.voice_channel = SimChannel(id * 10 + 2, self, '通話')
+        self._channels = {self.text_channel.id: self.text_channel, self.voice_channel.id: self.voice_channel}
+        self._roles = {}
+        self._members = {}
+        for i in range(n_members):
+            self.member(id * 10000 + i)
+
+    @property
+    def voice_client(self) -> SimVoiceClient:
+        return self.sim_voice_client
+
+    @property
+    def voice_channels(self) -> List[SimChannel]:
+        return [self.voice_channel]
+
+    def member(self, id:int) -> SimMember:
+        if (member := self._members.get(id)) is None:
+            member = self._members[id] = SimMember(id, f'user{id % 10000}', self)
+        return member
+
+
+class SimMessage:
+    def __init__(self, content:str, guild:SimGuild, author:SimMember) -> None:
+        self.content = content
+        self.guild = guild
+        self.author = author
+        self.channel = guild.text_channel
+        #bot.process_commandsがContextを作るときに使う
+        self._state = discordbot.bot._connection
+        self.mentions = [guild._members[int(id)] for id in re.findall(r'<@!?(\d+)>', content) if int(id) in guild._members]
+
+
+def load_corpus() -> List[str]:
+    with open(CORPUS, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def generate_trace(n_guilds:int, n_members:int, rate:float, voice_rate:float, duration:float, seed:int) -> List[dict]:
+    """サーバーごとにrate件/秒のメッセージとvoice_rate件/秒の入退室をポアソン過程で作る．"""
+    rng = random.Random(seed)
+    corpus = load_corpus()
+    events = []
+    for guild in range(1, n_guilds + 1):
+        t = rng.expovariate(rate)
+        while t < duration:
+            content = rng.choice(corpus)
+            #メンションのidはサーバーのメンバーとテキストチャンネルに付け替える
+            content = re.sub(r'<@!?\d+>', lambda _: f'<@!{guild * 10000 + rng.randrange(n_members)}>', content)
+            content = re.sub(r'<#\d+>', f'<#{guild * 10 + 1}>', content)
+            events.append({'t': t, 'type': 'message', 'guild': guild, 'user': rng.randrange(n_members), 'content': content})
+            t += rng.expovariate(rate)
+        if voice_rate > 0:
+            t = rng.expovariate(voice_rate)
+            while t < duration:
+                events.append({'t': t, 'type': 'voice', 'guild': guild, 'user': n_members + rng.randrange(n_members), 'action': rng.choice(['join', 'leave'])})
+                t += rng.expovariate(voice_rate)
+    events.sort(key=lambda event: event['t'])
+    return events
+
+
+class Simulator:
+    def __init__(self, n_members:int, bot_user:SimpleNamespace) -> None:
+        self.n_members = n_members
+        self.bot_user = bot_user
+        self.guilds: Dict[int, SimGuild] = {}
+        self.handlers = set()
+        self.n_messages = 0
+        self.n_voice_events = 0
+        self.errors = 0
+        self.samples = []
+
+    async def guild(self, id:int) -> SimGuild:
+        if (guild := self.guilds.get(id)) is None:
+            guild = self.guilds[id] = SimGuild(id, self.n_members, self.bot_user)
+            #botは最初からVCにいて，メンバーの半分も入室済みにする
+            await guild.voice_channel.connect()
+            for i in range(self.n_members // 2):
+                member = guild.member(id * 10000 + i)
+                member.sim_voice = SimpleNamespace(channel=guild.voice_channel, self_mute=False)
+                guild.voice_channel.members.append(member)
+        return guild
+
+    def spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self.handlers.add(task)
+        task.add_done_callback(self.on_handled)
+
+    def on_handled(self, task:asyncio.Task) -> None:
+        self.handlers.discard(task)
+        if (not task.cancelled()) and (task.exception() is not None):
+            self.errors += 1
+            if self.errors <= 5:
+                print(f'{task.exception().__class__.__name__}: {task.exception()}', file=sys.stderr)
+
+    async def dispatch(self, event:dict) -> None:
+        guild = await self.guild(event['guild'])
+        if event['type'] == 'message':
+            author = guild.member(event['guild'] * 10000 + event['user'] % 10000)
+            if author.sim_voice is None:
+                author.sim_voice = SimpleNamespace(channel=guild.voice_channel, self_mute=False)
+                guild.voice_channel.members.append(author)
+            self.n_messages += 1
+            #ゲートウェイと同じくハンドラは別タスクで動かす
+            self.spawn(discordbot.on_message(SimMessage(event['content'], guild, author)))
+        elif event['type'] == 'voice':
+            member = guild.member(event['guild'] * 10000 + event['user'] % 10000)
+            joined = SimpleNamespace(channel=guild.voice_channel, self_mute=False)
+            left = SimpleNamespace(channel=None, self_mute=False)
+            if (event['action'] == 'join') and (member.sim_voice is None):
+                member.sim_voice = joined
+                guild.voice_channel.members.append(member)
+                before, after = left, joined
+            elif (event['action'] == 'leave') and (member.sim_voice is not None) and (len(guild.voice_channel.members) > 2):
+                member.sim_voice = None
+                guild.voice_channel.members.remove(member)
+                before, after = joined, left
+            else:
+                return
+            self.n_voice_events += 1
+            self.spawn(discordbot.on_voice_state_update(member, before, after))
+
+    async def sample(self, interval:float) -> None:
+        #キューの深さを定期的に記録する
+        start = time.perf_counter()
+        while True:
+            players = list(discordbot.players.values())
+            depths = [player.qsize() for player in players]
+            self.samples.append({
+                't': time.perf_counter() - start,
+                'handlers': len(self.handlers),
+                'scheduler_queued': discordbot.scheduler.n_queued,
+                'scheduler_inflight': discordbot.scheduler.n_inflight,
+                'player_queued': sum(depths),
+                'player_queued_max': max(depths, default=0),
+                'pool_queue': discordbot.tts.pool.qsize()
+            })
+            await asyncio.sleep(interval)
+
+    async def replay(self, events:List[dict], drain:float) -> float:
+        sampler = asyncio.create_task(self.sample(1.0))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for event in events:
+            if (delay := start + event['t'] - loop.time()) > 0:
+                await asyncio.sleep(delay)
+            await self.dispatch(event)
+        elapsed = loop.time() - start
+        #積まれた分を読み終えるまで待つ
+        deadline = loop.time() + drain
+        while (loop.time() < deadline) and (self.handlers or any(player.qsize() for player in discordbot.players.values()) or any(guild.sim_voice_client and guild.sim_voice_client.is_playing() for guild in self.guilds.values())):
+            await asyncio.sleep(0.1)
+        sampler.cancel()
+        return elapsed
+
+
+def percentiles(name:str) -> dict:
+    result = {}
+    for labels, histogram in metrics.histograms.get(name, {}).items():
+        key = ','.join([f'{k}={v}' for k, v in labels]) or 'all'
+        result[key] = {'count': histogram.count, 'mean': histogram.sum / histogram.count if histogram.count else 0.0, 'p50': histogram.quantile(0.5), 'p90': histogram.quantile(0.9), 'p99': histogram.quantile(0.99), 'max': max(histogram.recent, default=0.0)}
+    return result
+
+
+def summarize(samples:List[dict]) -> dict:
+    keys = [key for key in (samples[0] if samples else {}) if key != 't']
+    return {key: {'max': max(sample[key] for sample in samples), 'mean': sum(sample[key] for sample in samples) / len(samples)} for key in keys}
+
+
+async def simulate(args:argparse.Namespace) -> dict:
+    if args.trace is not None:
+        with open(args.trace, encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = generate_trace(args.guilds, args.members, args.rate, args.voice_rate, args.duration, args.seed)
+    if args.save_trace is not None:
+        with open(args.save_trace, 'w', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    #Discord・Postgres・open_jtalkを置き換える
+    bot_user = SimpleNamespace(id=1, name='しゃべりな', bot=True)
+    discordbot.bot._connection.user = bot_user
+    discordbot.pg = MemoryPostgres(args.db_latency, write_behind=args.write_behind)
+    await discordbot.pg.connect()
+    discordbot.tts = TTS(args.openjtalk, args.workers)
+    discordbot.scheduler = SynthesisScheduler(discordbot.tts, max_inflight_per_guild=args.inflight_per_guild, max_queued=args.max_queued)
+    async def update_presence(n_voice:int, n_guilds:int) -> None:
+        pass
+    discordbot.cluster.on_change = update_presence
+
+    simulator = Simulator(args.members, bot_user)
+    elapsed = await simulator.replay(events, args.drain)
+    for player in list(discordbot.players.values()):
+        player.close()
+    await discordbot.tts.close()
+    await discordbot.pg.disconnect()
+
+    counters = {name: {','.join([f'{k}={v}' for k, v in labels]) or 'all': value for labels, value in series.items()} for name, series in metrics.counters.items()}
+    return {
+        'config': {key: value for key, value in vars(args).items()},
+        'events': len(events),
+        'messages': simulator.n_messages,
+        'voice_events': simulator.n_voice_events,
+        'guilds': len(simulator.guilds),
+        'elapsed': elapsed,
+        'throughput': {
+            'messages_per_sec': simulator.n_messages / elapsed if elapsed else 0.0,
+            'synthesized_per_sec': metrics.histograms.get('synthesis_seconds', {}).get((('backend', 'local'),), SimpleNamespace(count=0)).count / elapsed if elapsed else 0.0
+        },
+        'latency': {
+            'message_to_audio': percentiles('message_to_audio_seconds'),
+            'playback_wait': percentiles('playback_wait_seconds'),
+            'synthesis': percentiles('synthesis_seconds'),
+            'config_fetch': percentiles('config_fetch_seconds')
+        },
+        'queues': summarize(simulator.samples),
+        'dropped': {
+            'scheduler': discordbot.scheduler.stats()['dropped'],
+            'counters': counters.get('dropped_messages_total', {})
+        },
+        'counters': counters,
+        'db_queries': discordbot.pg.n_queries,
+        'handler_errors': simulator.errors
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--members', type=int, default=20, help='サーバーあたりのメンバー数')
+    parser.add_argument('--rate', type=float, default=0.2, help='サーバーあたりのメッセージ数/秒')
+    parser.add_argument('--voice-rate', type=float, default=0.01, help='サーバーあたりの入退室数/秒')
+    parser.add_argument('--duration', type=float, default=30.0, help='イベントを生成する秒数')
+    parser.add_argument('--drain', type=float, default=30.0, help='最後のイベントの後に読み終わるまで待つ最大秒数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', default=None, help='再生するトレース(JSONL)')
+    parser.add_argument('--save-trace', default=None, help='再生するイベントを書き出すファイル')
+    parser.add_argument('--openjtalk', default=STUB_DIR, help='open_jtalkのあるディレクトリ')
+    parser.add_argument('--workers', type=int, default=None, help='合成ワーカー数(未指定ならCPU数)')
+    parser.add_argument('--inflight-per-guild', type=int, default=2)
+    parser.add_argument('--max-queued', type=int, default=256)
+    parser.add_argument('--db-latency', type=float, default=0.002, help='MemoryPostgresの問い合わせ1回あたりの秒数')
+    parser.add_argument('--write-behind', type=float, default=0)
+    parser.add_argument('--out', default=None, help='結果を書き出すファイル(未指定なら標準出力)')
+    args = parser.parse_args()
+
+    #各モジュールの情報ログは量が多いので警告以上だけにする
+    for name in ['discordbot', 'postgres', 'tts', 'player', 'scheduler', 'utils']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    result = discordbot.bot.loop.run_until_complete(simulate(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
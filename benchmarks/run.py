@@ -0,0 +1,93 @@
+"""ベンチマークをまとめて実行し，結果をJSONで書き出す．Discordやネットワークには繋がない．
+
+    python benchmarks/run.py [--only text,lru] [--out result.json] [--compare before.json] [--quick]
+
+--compareを付けると，以前の結果と比べた比(今回/以前，1より小さければ速くなった)も出力する．
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_dsp
+import bench_lru
+import bench_normalizer
+import bench_text
+import bench_tokenizer
+import bench_tts
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#名前 -> (通常, --quick) の実行内容
+SUITES = {
+    'text': (lambda: bench_text.bench(), lambda: bench_text.bench(number=20)),
+    'normalizer': (lambda: bench_normalizer.bench(), lambda: bench_normalizer.bench(number=200)),
+    'tokenizer': (lambda: bench_tokenizer.bench(), lambda: bench_tokenizer.bench(number=20)),
+    'lru': (lambda: bench_lru.bench(), lambda: bench_lru.bench(n_ops=20000)),
+    'tts': (lambda: bench_tts.bench(), lambda: bench_tts.bench(number=2)),
+    'dsp': (lambda: bench_dsp.bench(), lambda: bench_dsp.bench(number=1))
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, before):
+    """両方にある数値の比を同じ形の辞書で返す．件数などの数値も含まれるので，見るのは時間の項目だけでよい．"""
+    if isinstance(current, dict) and isinstance(before, dict):
+        ratios = {key: compare(current[key], before[key]) for key in current if key in before}
+        return {key: value for key, value in ratios.items() if value is not None}
+    if isinstance(current, (int, float)) and isinstance(before, (int, float)) and not isinstance(current, bool) and before:
+        return current / before
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', default=','.join(SUITES), help='実行するベンチマーク(カンマ区切り)')
+    parser.add_argument('--out', default=None, help='結果を書き出すファイル(未指定なら標準出力)')
+    parser.add_argument('--compare', default=None, help='比較する以前の結果')
+    parser.add_argument('--quick', action='store_true', help='回数を減らして手早く確認する')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only.split(','):
+        normal, quick = SUITES[name]
+        print(f'{name}を実行しています．', file=sys.stderr)
+        results[name] = quick() if args.quick else normal()
+
+    output = {
+        'meta': {
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'quick': args.quick
+        },
+        'results': results
+    }
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            before = json.load(f)
+        output['compare'] = {'revision': before['meta']['revision'], 'ratio': compare(results, before['results'])}
+
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
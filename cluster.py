@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Tuple
+
+import asyncpg
+from discord.ext import commands
+
+from postgres import Postgres
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+#プロセス間のやりとりに使うチャンネル
+CLUSTER_CHANNEL = 'shaberina_cluster'
+#NOTIFYのペイロードは8000バイト未満
+MAX_PAYLOAD = 7900
+
+
+class Cluster:
+    """シャードを複数のプロセスに分けて動かすときに，プロセス間で状態とお知らせを共有する．
+
+    各プロセスは自分のVC接続数と導入サーバー数をPostgresのNOTIFYで定期的に流し，
+    他のプロセスの値と合わせて全体の数を求める．お知らせは全プロセスに配って送信数を集計する．
+    enabledがFalseのときは自分のプロセスだけで完結する．
+    """
+    def __init__(self, pg:Postgres, bot:commands.Bot, enabled:bool=False, heartbeat:float=30.0) -> None:
+        self.pg = pg
+        self.bot = bot
+        self.enabled = enabled
+        self.heartbeat = heartbeat
+        self.origin = pg.origin
+        #他のプロセスの状態 origin -> (受け取った時刻, VC接続数, 導入サーバー数)
+        self.peers: Dict[str, Tuple[float, int, int]] = {}
+        #集計中のお知らせ id -> [送信できた数, 対象のサーバー数, 返事をくれたプロセス数]
+        self.pending: Dict[str, list] = {}
+        self.last_totals = None
+        self.heartbeater = None
+        #全体の数が変わったときとお知らせを受け取ったときに呼ぶ関数
+        self.on_change: Callable[[int, int], Awaitable[None]] = None
+        self.on_notify: Callable[[str], Awaitable[Tuple[int, int]]] = None
+
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        await self.pg.subscribe(CLUSTER_CHANNEL, self.on_message)
+        if self.heartbeater is None:
+            self.heartbeater = asyncio.create_task(self.heartbeat_loop())
+
+
+    def local_counts(self) -> Tuple[int, int]:
+        return len(self.bot.voice_clients), len(self.bot.guilds)
+
+
+    def totals(self) -> Tuple[int, int]:
+        n_voice, n_guilds = self.local_counts()
+        #止まったプロセスの分は数えない
+        now = time.monotonic()
+        self.peers = {origin: peer for origin, peer in self.peers.items() if now - peer[0] < 3 * self.heartbeat}
+        for _, peer_voice, peer_guilds in self.peers.values():
+            n_voice += peer_voice
+            n_guilds += peer_guilds
+        return n_voice, n_guilds
+
+
+    async def publish(self, op:str, **data) -> None:
+        payload = json.dumps({'origin': self.origin, 'op': op, **data}, ensure_ascii=False)
+        if len(payload.encode()) > MAX_PAYLOAD:
+            raise ValueError(f'通知が長すぎます．({len(payload.encode())}/{MAX_PAYLOAD}バイト)')
+        await self.pg.publish(CLUSTER_CHANNEL, payload)
+
+
+    async def update(self, force:bool=False) -> None:
+        """自分の数が変わったら呼ぶ．他のプロセスに知らせてから全体の数を反映する．
+
+        forceがTrueなら，数が同じでもpresenceを設定し直す(再接続でpresenceが消えたときなど)．
+        """
+        if self.enabled:
+            n_voice, n_guilds = self.local_counts()
+            try:
+                await self.publish('state', n_voice=n_voice, n_guilds=n_guilds)
+            except Exception as error:
+                logger.error(f'{error.__class__.__name__}: {error}')
+        await self.refresh(force)
+
+
+    async def refresh(self, force:bool=False) -> None:
+        #同じ数ならpresenceを更新しない(forceのときを除く)
+        if (((totals := self.totals()) != self.last_totals) or force) and (self.on_change is not None):
+            self.last_totals = totals
+            await self.on_change(*totals)
+
+
+    async def heartbeat_loop(self) -> None:
+        while True:
+            await self.update()
+            await asyncio.sleep(self.heartbeat)
+
+
+    def on_message(self, con:asyncpg.Connection, pid:int, channel:str, payload:str) -> None:
+        try:
+            event = json.loads(payload)
+            origin, op = event['origin'], event['op']
+        except Exception as error:
+            logger.error(f'不正な通知を受け取りました．({error.__class__.__name__}: {error})')
+            return
+        if op == 'state':
+            if origin == self.origin:
+                return
+            #初めて見えたプロセスには自分の数を返して，すぐに全体の数を揃える
+            is_new = origin not in self.peers
+            self.peers[origin] = (time.monotonic(), event['n_voice'], event['n_guilds'])
+            asyncio.create_task(self.update() if is_new else self.refresh())
+        elif op == 'notify':
+            asyncio.create_task(self.deliver(event['id'], event['text']))
+        elif op == 'notified':
+            if (result := self.pending.get(event['id'])) is not None:
+                result[0] += event['sent']
+                result[1] += event['total']
+                result[2] += 1
+
+
+    async def deliver(self, id:str, text:str) -> None:
+        sent, total = await self.on_notify(text)
+        try:
+            await self.publish('notified', id=id, sent=sent, total=total)
+        except Exception as error:
+            logger.error(f'{error.__class__.__name__}: {error}')
+
+
+    async def broadcast_notify(self, text:str, timeout:float=30.0) -> Tuple[int, int]:
+        """全プロセスの導入サーバーにお知らせを送り，(送信できた数, 対象のサーバー数)を返す．"""
+        if not self.enabled:
+            return await self.on_notify(text)
+        id = uuid.uuid4().hex
+        result = self.pending[id] = [0, 0, 0]
+        try:
+            await self.publish('notify', id=id, text=text)
+            #自分も含めて生きているプロセスがすべて返事をするまで待つ
+            deadline = time.monotonic() + timeout
+            while (result[2] < len(self.peers) + 1) and (time.monotonic() < deadline):
+                await asyncio.sleep(0.5)
+            if result[2] < len(self.peers) + 1:
+                logger.warning(f'一部のプロセスからお知らせの送信結果が返ってきませんでした．({result[2]}/{len(self.peers) + 1})')
+        finally:
+            del self.pending[id]
+        return result[0], result[1]
+
+
+    async def close(self) -> None:
+        if self.heartbeater is not None:
+            self.heartbeater.cancel()
+            self.heartbeater = None
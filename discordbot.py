@@ -3,11 +3,19 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import os
-from copy import deepcopy
+import time
+from typing import Tuple
 
 from utils import *
 from postgres import Postgres
 from tts import TTS
+from tts_service import RemoteTTS
+from audio import load_wav, encode_opus, opus_available
+from audio_cache import AudioCache
+from player import GuildPlayer
+from scheduler import SynthesisScheduler
+from cluster import Cluster
+from metrics import metrics
 
 from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
 
@@ -24,66 +32,202 @@ logger.addHandler(hdlr)
 load_dotenv()
 TOKEN = os.environ['TOKEN']
 DATABASE_URL = os.environ['DATABASE_URL']
-
-pg = Postgres(DATABASE_URL)
-tts = TTS()
-
-default_prefix = pg.get_default('guild')['prefix']
+#open_jtalkの同時起動数（未設定ならCPU数）
+TTS_CONCURRENCY = int(os.environ.get('TTS_CONCURRENCY') or 0) or None
+#合成音声キャッシュの容量(MB)と保存先（保存先が未設定ならメモリのみ）
+AUDIO_CACHE_MB = int(os.environ.get('AUDIO_CACHE_MB') or 64)
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR') or None
+AUDIO_CACHE_DISK_MB = int(os.environ.get('AUDIO_CACHE_DISK_MB') or 512)
+
+#設定キャッシュの件数
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 100)
+GUILD_CACHE_SIZE = int(os.environ.get('GUILD_CACHE_SIZE') or 50)
+#設定の書き込みをまとめる間隔(秒, 0なら都度書き込む)
+PG_WRITE_BEHIND_SEC = float(os.environ.get('PG_WRITE_BEHIND_SEC') or 0)
+#起動時に導入サーバー数とVC参加者数に合わせてキャッシュ件数を広げるか
+CACHE_AUTOSIZE = os.environ.get('CACHE_AUTOSIZE', '').lower() in {'1', 'true', 'yes'}
+
+#他のプロセスとLISTEN/NOTIFYで設定の変更を共有するか
+PG_LISTEN = os.environ.get('PG_LISTEN', 'true').lower() in {'1', 'true', 'yes'}
+#コネクションプールの最小・最大接続数とクエリのタイムアウト(秒, 0なら無制限)
+PG_POOL_MIN = int(os.environ.get('PG_POOL_MIN') or 2)
+PG_POOL_MAX = int(os.environ.get('PG_POOL_MAX') or 8)
+PG_TIMEOUT = float(os.environ.get('PG_TIMEOUT') or 0) or None
+
+pg = Postgres(DATABASE_URL, {'user': USER_CACHE_SIZE, 'guild': GUILD_CACHE_SIZE}, PG_WRITE_BEHIND_SEC, PG_LISTEN, (PG_POOL_MIN, PG_POOL_MAX), PG_TIMEOUT)
+audio_cache = AudioCache(AUDIO_CACHE_MB * 2**20, AUDIO_CACHE_DIR, AUDIO_CACHE_DISK_MB * 2**20)
+#合成サーバー(tts_service.py)のアドレス．unix:/path/to/sock または host:port（未設定ならこのプロセスで合成）
+TTS_SERVICE_ADDR = os.environ.get('TTS_SERVICE_ADDR') or None
+#合成サーバーに同時に頼む件数と待ち時間(秒)，使えないときにこのプロセスで合成するか
+TTS_SERVICE_CONCURRENCY = int(os.environ.get('TTS_SERVICE_CONCURRENCY') or 8)
+TTS_SERVICE_TIMEOUT = float(os.environ.get('TTS_SERVICE_TIMEOUT') or 10)
+TTS_SERVICE_FALLBACK = os.environ.get('TTS_SERVICE_FALLBACK', 'true').lower() in {'1', 'true', 'yes'}
+#合成した音声をその場でOpusに符号化しておき，再生時の符号化を省くか（libopusがなければ無効）
+OPUS_PREENCODE = os.environ.get('OPUS_PREENCODE', 'true').lower() in {'1', 'true', 'yes'} and opus_available()
+#スピードとエフェクトを後処理で付け，基準の音声を使い回すか（NumPyが必要）
+TTS_DSP = os.environ.get('TTS_DSP', '').lower() in {'1', 'true', 'yes'}
+if TTS_SERVICE_ADDR is None:
+    tts = TTS(max_concurrency=TTS_CONCURRENCY, cache=audio_cache, opus=OPUS_PREENCODE, postprocess=TTS_DSP)
+else:
+    fallback = TTS(max_concurrency=TTS_CONCURRENCY, opus=OPUS_PREENCODE, postprocess=TTS_DSP) if TTS_SERVICE_FALLBACK else None
+    tts = RemoteTTS(TTS_SERVICE_ADDR, TTS_SERVICE_CONCURRENCY, timeout=TTS_SERVICE_TIMEOUT, cache=audio_cache, fallback=fallback)
+#サーバー間で合成を公平に割り振る（同時合成数はサーバーごと，待ち件数は全体の上限）
+SCHED_INFLIGHT_PER_GUILD = int(os.environ.get('SCHED_INFLIGHT_PER_GUILD') or 2)
+SCHED_MAX_QUEUED = int(os.environ.get('SCHED_MAX_QUEUED') or 256)
+scheduler = SynthesisScheduler(tts, max_inflight_per_guild=SCHED_INFLIGHT_PER_GUILD, max_queued=SCHED_MAX_QUEUED)
+#待ち行列の深さやキャッシュの件数はメトリクスを書き出すたびに集める
+#サーバーごとの値はサーバーの数だけ系列が増えるので，latencyでだけ見る
+metrics.gauge('scheduler', lambda: scheduler.stats(top=0))
+metrics.gauge('tts', tts.stats)
+metrics.gauge('audio_cache', audio_cache.stats)
+metrics.gauge('postgres', pg.stats)
+#効果音は起動時に一度だけデコード(と符号化)しておく
+cues = {name: load_wav(f'./wav/{name}.wav') for name in ['join', 'leave', 'already_joined', 'auto_join']}
+if OPUS_PREENCODE:
+    cues = {name: encode_opus(pcm) for name, pcm in cues.items()}
+#サーバーごとの再生キューと先読みする件数・容量(MB)
+players = {}
+PLAYER_LOOKAHEAD = int(os.environ.get('PLAYER_LOOKAHEAD') or 2)
+PLAYER_BUFFER_MB = int(os.environ.get('PLAYER_BUFFER_MB') or 8)
+#メトリクスを公開するポート（未設定なら公開しない）
+METRICS_HOST = os.environ.get('METRICS_HOST') or '127.0.0.1'
+METRICS_PORT = int(os.environ.get('METRICS_PORT') or 0)
+metrics_runner = None
+#on_readyは再接続のたびに呼ばれるので，起動時の処理と終了時の処理は1回だけにする
+started = False
+services_closed = False
+
+default_prefix = pg.get_default('guild').prefix
 
 async def fetch_prefix(bot:commands.Bot, message:discord.Message) -> str:
     if message.guild is None:
         return default_prefix
     else:
         guild_conf = await pg.fetch(message.guild)
-        return guild_conf['prefix']
+        return guild_conf.prefix
+
+#シャード数と，このプロセスで受け持つシャード(カンマ区切り)．launcher.pyから起動すると設定される
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT') or 0) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.environ.get('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+
+async def close_services() -> None:
+    global services_closed
+    if services_closed:
+        return
+    services_closed = True
+    #書き込み待ちの設定を保存してから，合成と他のプロセスとの連携を止める
+    for close in [pg.disconnect, tts.close, cluster.close]:
+        try:
+            await close()
+        except Exception as error:
+            logger.error(f'{error.__class__.__name__}: {error}')
+
+
+class ShutdownMixin:
+    """shutdownコマンドだけでなく，SIGTERM(launcher.pyやHerokuの再起動)でbot.closeが呼ばれたときも後始末をする．"""
+    async def close(self) -> None:
+        await close_services()
+        await super().close()
+
 
-bot = commands.Bot(command_prefix=fetch_prefix, help_command=None)
+class Bot(ShutdownMixin, commands.Bot):
+    pass
+
+
+class AutoShardedBot(ShutdownMixin, commands.AutoShardedBot):
+    pass
+
+
+if (SHARD_COUNT is None) and (SHARD_IDS is None):
+    bot = Bot(command_prefix=fetch_prefix, help_command=None)
+else:
+    bot = AutoShardedBot(command_prefix=fetch_prefix, help_command=None, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+#シャードを複数のプロセスで分けているときは，サーバー数やお知らせを他のプロセスと共有する
+cluster = Cluster(pg, bot, enabled=SHARD_IDS is not None)
 
 ########################################################################################################
 #ここから内部関数の定義
 
 async def is_target_ch(ctx:commands.Context) -> bool:
     guild_conf = await pg.fetch(ctx.guild)
-    if (guild_conf['target_ch'] == 'all') or (guild_conf['target_ch'] == str(ctx.channel.id)):
+    if (guild_conf.target_ch == 'all') or (guild_conf.target_ch == str(ctx.channel.id)):
         return True
     else:
         #helpを操作チャンネル以外から使用した場合のみ出力
         #　Noneが返ってくるのはon_message内のhelpでの判定時
         if ctx.command in {None, help}:
-            await ctx.send(f'<#{guild_conf["target_ch"]}>から操作してください．')
+            await ctx.send(f'<#{guild_conf.target_ch}>から操作してください．')
         return False
 
 
-async def play_wav(wavpath:str, voice_client:discord.VoiceClient) -> None:
+async def warm_up_cache() -> None:
+    #再起動直後の最初のメッセージでDBを待たないように，導入サーバーとVCにいるユーザーの設定を先に読み込む
+    guild_ids = [guild.id for guild in bot.guilds]
+    user_ids = list({member.id for guild in bot.guilds for ch in guild.voice_channels for member in ch.members if not member.bot})
+    if CACHE_AUTOSIZE:
+        #少し余裕を持たせる
+        if (size := len(guild_ids) * 5 // 4) > pg.cache['guild'].size:
+            pg.cache['guild'].resize(size)
+        if (size := len(user_ids) * 2) > pg.cache['user'].size:
+            pg.cache['user'].resize(size)
     try:
-        source = discord.FFmpegPCMAudio(wavpath, before_options='-channel_layout mono')
-        while voice_client.is_playing():
-            await asyncio.sleep(1)
-        voice_client.play(source)
-    except (discord.ClientException, AttributeError):
-        pass
+        n_guilds = await pg.preload('guild', guild_ids)
+        n_users = await pg.preload('user', user_ids)
+        logger.info(f'設定を読み込みました．(サーバー: {n_guilds}/{len(guild_ids)}, ユーザー: {n_users}/{len(user_ids)})')
     except Exception as error:
         logger.error(f'{error.__class__.__name__}: {error}')
 
 
-async def read_text(text:str, voice_conf:dict, voice_client:discord.VoiceClient) -> None:
+def get_player(voice_client:discord.VoiceClient) -> GuildPlayer:
+    player = players.get(voice_client.guild.id)
+    #再接続などでVoiceClientが変わっていれば作り直す
+    if (player is None) or (player.voice_client is not voice_client):
+        if player is not None:
+            player.close()
+        player = players[voice_client.guild.id] = GuildPlayer(voice_client, scheduler, PLAYER_LOOKAHEAD, PLAYER_BUFFER_MB * 2**20)
+    return player
+
+
+def close_player(guild:discord.Guild) -> None:
+    if (player := players.pop(guild.id, None)) is not None:
+        player.close()
+
+
+async def play_cue(name:str, voice_client:discord.VoiceClient) -> None:
+    if voice_client is None:
+        return
+    get_player(voice_client).enqueue_audio(cues[name])
+
+
+async def read_text(text:str, voice_conf:UserConf, voice_client:discord.VoiceClient, received_at:float=None) -> None:
     if (voice_client is None) or (text == ''):
         return
+    #キューに積むだけで再生の終了は待たない
+    get_player(voice_client).enqueue_text(text, voice_conf, received_at)
 
-    wavpath = None
-    try:
-        wavpath = tts.synthesize(text, **voice_conf)
-        if (wavpath is not None) and os.path.exists(wavpath):
-            await play_wav(wavpath, voice_client)
-            while voice_client.is_playing():
-                await asyncio.sleep(1)
-    except (discord.ClientException, AttributeError):
-        pass
-    except Exception as error:
-        logger.error(f'{error.__class__.__name__}: {error}')
-    finally:
-        if (wavpath is not None) and os.path.exists(wavpath):
-            os.remove(wavpath)
+
+async def update_presence(n_voice:int, n_guilds:int) -> None:
+    presence = f'{default_prefix}help | {n_voice}/{n_guilds}サーバー'
+    await bot.change_presence(activity=discord.Game(name=presence))
+
+
+async def deliver_notify(text:str) -> Tuple[int, int]:
+    embed = discord.Embed(color=0x9edfe8, title='◆◇◆◇◆お知らせ◆◇◆◇◆', description=text)
+    ch_dic = await pg.fetchall_targetch()
+    tasks = []
+    for guild in bot.guilds:
+        target_ch = ch_dic.setdefault(str(guild.id), 'all')
+        if target_ch == 'all':
+            notify_ch = guild.system_channel
+        else:
+            notify_ch = await bot.fetch_channel(int(target_ch))
+        tasks.append(send_notify(guild.name, notify_ch, embed))
+    done = await asyncio.gather(*tasks)
+    return sum(done), len(bot.guilds)
+
+
+cluster.on_change = update_presence
+cluster.on_notify = deliver_notify
 
 
 async def send_notify(guild_name:str, ch:discord.TextChannel, embed:discord.Embed) -> bool:
@@ -103,16 +247,25 @@ async def send_notify(guild_name:str, ch:discord.TextChannel, embed:discord.Embe
 @bot.event
 async def on_ready():
     logger.info(f'{bot.user.name}のログインに成功しました．')
-    await pg.connect()
-    presence = f'{default_prefix}help | 0/{len(bot.guilds)}サーバー'
-    await bot.change_presence(activity=discord.Game(name=presence))
+    global started, metrics_runner
+    if not started:
+        #接続に失敗したら次のon_readyでやり直す(connectとstartは2回呼んでも二重にならない)
+        await pg.connect()
+        await cluster.start()
+        asyncio.create_task(warm_up_cache())
+        #文字の正規化に使う表は作るのに時間がかかるので，最初のメッセージより前にスレッドで作っておく
+        asyncio.get_running_loop().run_in_executor(None, lambda: normalize_table.unsafe)
+        if METRICS_PORT and (metrics_runner is None):
+            metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        started = True
+    #再接続でプレゼンスが消えるので，数が変わっていなくても毎回設定し直す
+    await cluster.update(force=True)
 
 
 @bot.event
 async def on_guild_join(guild:discord.Guild):
     logger.info(f'サーバー「{guild.name}」に招待されました．')
-    presence = f'{default_prefix}help | {len(bot.voice_clients)}/{len(bot.guilds)}サーバー'
-    await bot.change_presence(activity=discord.Game(name=presence))
+    await cluster.update()
     try:
         await guild.system_channel.send(embed=invited_embed(default_prefix))
     except Exception:
@@ -122,8 +275,7 @@ async def on_guild_join(guild:discord.Guild):
 @bot.event
 async def on_guild_remove(guild:discord.Guild):
     logger.info(f'サーバー「{guild.name}」からキックされました．')
-    presence = f'{default_prefix}help | {len(bot.voice_clients)}/{len(bot.guilds)}サーバー'
-    await bot.change_presence(activity=discord.Game(name=presence))
+    await cluster.update()
 
 
 #botのオーナーのみ使用可
@@ -132,7 +284,6 @@ async def on_guild_remove(guild:discord.Guild):
 async def shutdown(ctx:commands.Context, option:str=None):
     if option == '-y':
         await ctx.send('メンテナンスのためしばらく眠ります．おやすみなさい．')
-        await pg.disconnect()
         await bot.close()
         logger.info(f'{bot.user.name}をシャットダウンしました．')
     else:
@@ -142,13 +293,29 @@ async def shutdown(ctx:commands.Context, option:str=None):
         msg = await bot.wait_for('message', check=check)
         if msg.content == 'y':
             await ctx.send('メンテナンスのためしばらく眠ります．おやすみなさい．')
-            await pg.disconnect()
             await bot.close()
             logger.info(f'{bot.user.name}をシャットダウンしました．')
         else:
             await ctx.send('シャットダウンを中止しました．')
 
 
+#botのオーナーのみ使用可
+@bot.command()
+@commands.is_owner()
+async def latency(ctx:commands.Context):
+    lines = [f'{"":<40}{"count":>8}{"p50":>9}{"p95":>9}{"p99":>9}']
+    for name, labels, count, p50, p95, p99 in metrics.percentiles():
+        label = name + (f'{{{",".join([f"{k}={v}" for k, v in labels])}}}' if labels else '')
+        lines.append(f'{label:<40}{count:>8}{p50 * 1000:>7.1f}ms{p95 * 1000:>7.1f}ms{p99 * 1000:>7.1f}ms')
+    counters = [f'{name}{{{",".join([f"{k}={v}" for k, v in labels])}}} {value}' for name, series in sorted(metrics.counters.items()) for labels, value in sorted(series.items())]
+    gauges = [f'{name} {value}' for name, value in metrics.collect()]
+    #サーバーごとの値は待ち行列の深いものだけ
+    queues = [f'guild {guild_id}: queued {stat["queued"]}, inflight {stat["inflight"]}, wait {stat["avg_wait"] * 1000:.1f}ms (max {stat["max_wait"] * 1000:.1f}ms)' for guild_id, stat in scheduler.stats(top=5)['guilds'].items()]
+    text = '\n'.join(lines + [''] + gauges + [''] + queues + [''] + counters)
+    #メッセージの上限を超えないように切り詰める
+    await ctx.send(f'```\n{text[:1900]}\n```')
+
+
 #botのオーナーのみ使用可
 @bot.command()
 @commands.is_owner()
@@ -159,18 +326,14 @@ async def notify(ctx:commands.Context, *, text:str):
         return (m.author == ctx.author) and (m.content in {'y', 'n'})
     msg = await bot.wait_for('message', check=check)
     if msg.content == 'y':
-        ch_dic = await pg.fetchall_targetch()
-        tasks = []
-        for guild in bot.guilds:
-            target_ch = ch_dic.setdefault(str(guild.id), 'all')
-            if target_ch == 'all':
-                notify_ch = guild.system_channel
-            else:
-                notify_ch = await bot.fetch_channel(int(target_ch))
-            tasks.append(send_notify(guild.name, notify_ch, embed))
-        done = await asyncio.gather(*tasks)
-        await ctx.send(f'導入サーバーにお知らせを送信しました．({sum(done)}/{len(bot.guilds)})')
-        logger.info(f'導入サーバーにお知らせを送信しました．({sum(done)}/{len(bot.guilds)})')
+        #シャードを分けているときは他のプロセスが受け持つサーバーにも送る
+        try:
+            sent, total = await cluster.broadcast_notify(text)
+        except ValueError as error:
+            await ctx.send(f'お知らせを送信できませんでした．{error}')
+            return
+        await ctx.send(f'導入サーバーにお知らせを送信しました．({sent}/{total})')
+        logger.info(f'導入サーバーにお知らせを送信しました．({sent}/{total})')
     else:
         await ctx.send('お知らせの送信を中止しました．')
 
@@ -181,7 +344,7 @@ async def notify(ctx:commands.Context, *, text:str):
 async def help(ctx:commands.Context, option:normalized_str=None):
     logger.info(f'「{ctx.guild.name}」の「{ctx.author.name}」がコマンドを使用しました．')
     guild_conf = await pg.fetch(ctx.guild)
-    prefix = guild_conf['prefix']
+    prefix = guild_conf.prefix
     if option == 'voice':
         await ctx.send(embed=help_embed(prefix, 'voice'))
     elif option == 'setting':
@@ -200,10 +363,10 @@ async def join(ctx:commands.Context):
     else:
         if ctx.voice_client:
             if ctx.author.voice.channel == ctx.voice_client.channel:
-                await play_wav('./wav/already_joined.wav', ctx.voice_client)
+                await play_cue('already_joined', ctx.voice_client)
         else:
             await ctx.author.voice.channel.connect()
-            await play_wav('./wav/join.wav', ctx.voice_client)
+            await play_cue('join', ctx.voice_client)
 
 
 @bot.command()
@@ -214,9 +377,10 @@ async def leave(ctx:commands.Context):
     if ctx.voice_client is None:
         await ctx.send('ボイスチャンネルに入室していません．')
     else:
-        await play_wav('./wav/leave.wav', ctx.voice_client)
-        while ctx.voice_client.is_playing():
-            await asyncio.sleep(1)
+        #読み上げ待ちを捨てて再生中のものも止め，退室の効果音だけを流してから退室する
+        close_player(ctx.guild)
+        ctx.voice_client.stop()
+        await get_player(ctx.voice_client).enqueue_audio(cues['leave'])
         await ctx.voice_client.disconnect()
 
 
@@ -269,11 +433,10 @@ async def speaker(ctx:commands.Context, arg:normalized_str=None):
         await ctx.send(f'話者は [mei, takumi] から指定してください．\n例「{ctx.prefix}speaker mei」')
     else:
         old_voice_conf = await pg.fetch(ctx.author)
-        if arg == old_voice_conf['speaker']:
+        if arg == old_voice_conf.speaker:
             await ctx.send(f'すでに話者は「{arg}」に設定されています．')
         else:
-            new_voice_conf = deepcopy(old_voice_conf)
-            new_voice_conf['speaker'] = arg
+            new_voice_conf = old_voice_conf._replace(speaker=arg)
             embed = conf_embed(ctx.author, old_voice_conf, new_voice_conf)
             embed.set_author(name=f'話者を「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             text = my_normalizer(f'どうも，{ctx.author.display_name}です．')
@@ -293,11 +456,10 @@ async def emotion(ctx:commands.Context, arg:normalized_str=None):
         await ctx.send(f'感情は [normal, happy, angry, sad] から指定してください．\n例「{ctx.prefix}emotion happy」')
     else:
         old_voice_conf = await pg.fetch(ctx.author)
-        if arg == old_voice_conf['emotion']:
+        if arg == old_voice_conf.emotion:
             await ctx.send(f'すでに感情は「{arg}」に設定されています．')
         else:
-            new_voice_conf = deepcopy(old_voice_conf)
-            new_voice_conf['emotion'] = arg
+            new_voice_conf = old_voice_conf._replace(emotion=arg)
             embed = conf_embed(ctx.author, old_voice_conf, new_voice_conf)
             embed.set_author(name=f'感情を「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             text = my_normalizer(f'どうも，{ctx.author.display_name}です．')
@@ -317,11 +479,10 @@ async def effect(ctx:commands.Context, arg:normalized_str=None):
         await ctx.send(f'エフェクトは [none, robot, whisper] から指定してください．\n例「{ctx.prefix}effect whisper」')
     else:
         old_voice_conf = await pg.fetch(ctx.author)
-        if arg == old_voice_conf['effect']:
+        if arg == old_voice_conf.effect:
             await ctx.send(f'すでにエフェクトは「{arg}」に設定されています．')
         else:
-            new_voice_conf = deepcopy(old_voice_conf)
-            new_voice_conf['effect'] = arg
+            new_voice_conf = old_voice_conf._replace(effect=arg)
             embed = conf_embed(ctx.author, old_voice_conf, new_voice_conf)
             embed.set_author(name=f'エフェクトを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             text = my_normalizer(f'どうも，{ctx.author.display_name}です．')
@@ -341,11 +502,10 @@ async def tone(ctx:commands.Context, arg:signed_int_str=None):
         await ctx.send(f'トーンは [-5 ~ +5] の範囲で指定してください．\n例「{ctx.prefix}tone +2」')
     else:
         old_voice_conf = await pg.fetch(ctx.author)
-        if arg == old_voice_conf['tone']:
+        if arg == old_voice_conf.tone:
             await ctx.send(f'すでにトーンは「{arg}」に設定されています．')
         else:
-            new_voice_conf = deepcopy(old_voice_conf)
-            new_voice_conf['tone'] = arg
+            new_voice_conf = old_voice_conf._replace(tone=arg)
             embed = conf_embed(ctx.author, old_voice_conf, new_voice_conf)
             embed.set_author(name=f'トーンを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             text = my_normalizer(f'どうも，{ctx.author.display_name}です．')
@@ -365,11 +525,10 @@ async def speed(ctx:commands.Context, arg:signed_int_str=None):
         await ctx.send(f'スピードは [-5 ~ +5] の範囲で指定してください．\n例「{ctx.prefix}speed -1」')
     else:
         old_voice_conf = await pg.fetch(ctx.author)
-        if arg == old_voice_conf['speed']:
+        if arg == old_voice_conf.speed:
             await ctx.send(f'すでにスピードは「{arg}」に設定されています．')
         else:
-            new_voice_conf = deepcopy(old_voice_conf)
-            new_voice_conf['speed'] = arg
+            new_voice_conf = old_voice_conf._replace(speed=arg)
             embed = conf_embed(ctx.author, old_voice_conf, new_voice_conf)
             embed.set_author(name=f'スピードを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             text = my_normalizer(f'どうも，{ctx.author.display_name}です．')
@@ -412,11 +571,10 @@ async def prefix(ctx:commands.Context, arg:str=None):
         await ctx.send(f'プレフィックスを指定してください．空白を含める場合は""で囲ってください．\n例「{ctx.prefix}prefix !?」\n　「{ctx.prefix}prefix "!s "」')
     else:
         old_guild_conf = await pg.fetch(ctx.guild)
-        if arg == old_guild_conf['prefix']:
+        if arg == old_guild_conf.prefix:
             await ctx.send(f'すでプレフィックスは「{arg}」に設定されています．')
         else:
-            new_guild_conf = deepcopy(old_guild_conf)
-            new_guild_conf['prefix'] = arg
+            new_guild_conf = old_guild_conf._replace(prefix=arg)
             embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
             embed.set_author(name=f'プレフィックスを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             await asyncio.gather(
@@ -435,11 +593,10 @@ async def target_ch(ctx:commands.Context, arg:str=None):
     else:
         old_guild_conf = await pg.fetch(ctx.guild)
         if normalized_str(arg) == 'all':
-            if 'all' == old_guild_conf['target_ch']:
+            if 'all' == old_guild_conf.target_ch:
                 await ctx.send('すでに操作チャンネルは「all」に設定されています．')
             else:
-                new_guild_conf = deepcopy(old_guild_conf)
-                new_guild_conf['target_ch'] = 'all'
+                new_guild_conf = old_guild_conf._replace(target_ch='all')
                 embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
                 embed.set_author(name='操作チャンネルを「all」に変更しました．', icon_url=bot.user.avatar_url)
                 await asyncio.gather(
@@ -451,11 +608,10 @@ async def target_ch(ctx:commands.Context, arg:str=None):
             new_ch = await conv.convert(ctx, arg)
             if new_ch not in ctx.guild.text_channels:
                 await ctx.send(f'サーバー「{ctx.guild.name}」内のチャンネルを指定してください．')
-            elif str(new_ch.id) == old_guild_conf['target_ch']:
+            elif str(new_ch.id) == old_guild_conf.target_ch:
                 await ctx.send(f'すでに操作チャンネルは{new_ch.mention}に設定されています．')
             else:
-                new_guild_conf = deepcopy(old_guild_conf)
-                new_guild_conf['target_ch'] = str(new_ch.id)
+                new_guild_conf = old_guild_conf._replace(target_ch=str(new_ch.id))
                 embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
                 embed.set_author(name=f'操作チャンネルを「#{new_ch.name}」に変更しました．', icon_url=bot.user.avatar_url)
                 await asyncio.gather(
@@ -474,11 +630,10 @@ async def auto_join(ctx:commands.Context, arg:normalized_str=None):
     else:
         bool_arg = (arg == 'on')
         old_guild_conf = await pg.fetch(ctx.guild)
-        if bool_arg is old_guild_conf['auto_join']:
+        if bool_arg is old_guild_conf.auto_join:
             await ctx.send(f'すでに自動入室は「{arg}」に設定されています．')
         else:
-            new_guild_conf = deepcopy(old_guild_conf)
-            new_guild_conf['auto_join'] = bool_arg
+            new_guild_conf = old_guild_conf._replace(auto_join=bool_arg)
             embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
             embed.set_author(name=f'自動入室を「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             await asyncio.gather(
@@ -497,11 +652,10 @@ async def read_access(ctx:commands.Context, arg:normalized_str=None):
     else:
         bool_arg = (arg == 'on')
         old_guild_conf = await pg.fetch(ctx.guild)
-        if bool_arg is old_guild_conf['read_access']:
+        if bool_arg is old_guild_conf.read_access:
             await ctx.send(f'すでに入退室読み上げは「{arg}」に設定されています．')
         else:
-            new_guild_conf = deepcopy(old_guild_conf)
-            new_guild_conf['read_access'] = bool_arg
+            new_guild_conf = old_guild_conf._replace(read_access=bool_arg)
             embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
             embed.set_author(name=f'入退室読み上げを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             await asyncio.gather(
@@ -520,11 +674,10 @@ async def read_author(ctx:commands.Context, arg:normalized_str=None):
     else:
         bool_arg = (arg == 'on')
         old_guild_conf = await pg.fetch(ctx.guild)
-        if bool_arg is old_guild_conf['read_author']:
+        if bool_arg is old_guild_conf.read_author:
             await ctx.send(f'すでに送信者名読み上げは「{arg}」に設定されています．')
         else:
-            new_guild_conf = deepcopy(old_guild_conf)
-            new_guild_conf['read_author'] = bool_arg
+            new_guild_conf = old_guild_conf._replace(read_author=bool_arg)
             embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
             embed.set_author(name=f'送信者名読み上げを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             await asyncio.gather(
@@ -543,11 +696,10 @@ async def read_outsider(ctx:commands.Context, arg:normalized_str=None):
     else:
         bool_arg = (arg == 'on')
         old_guild_conf = await pg.fetch(ctx.guild)
-        if bool_arg is old_guild_conf['read_outsider']:
+        if bool_arg is old_guild_conf.read_outsider:
             await ctx.send(f'すでに非参加者読み上げは「{arg}」に設定されています．')
         else:
-            new_guild_conf = deepcopy(old_guild_conf)
-            new_guild_conf['read_outsider'] = bool_arg
+            new_guild_conf = old_guild_conf._replace(read_outsider=bool_arg)
             embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
             embed.set_author(name=f'非参加者読み上げを「{arg}」に変更しました．', icon_url=bot.user.avatar_url)
             await asyncio.gather(
@@ -556,11 +708,35 @@ async def read_outsider(ctx:commands.Context, arg:normalized_str=None):
             )
 
 
+@bot.command()
+@commands.guild_only()
+@commands.check(is_target_ch)
+async def max_chars(ctx:commands.Context, arg:normalized_str=None):
+    logger.info(f'「{ctx.guild.name}」の「{ctx.author.name}」がコマンドを使用しました．')
+    if (arg is None) or (not arg.isdecimal()) or (not 10 <= int(arg) <= 1000):
+        await ctx.send(f'最大文字数は [10 ~ 1000] の範囲で指定してください．\n例「{ctx.prefix}max_chars 200」')
+    else:
+        int_arg = int(arg)
+        old_guild_conf = await pg.fetch(ctx.guild)
+        if int_arg == old_guild_conf.max_chars:
+            await ctx.send(f'すでに最大文字数は「{int_arg}」に設定されています．')
+        else:
+            new_guild_conf = old_guild_conf._replace(max_chars=int_arg)
+            embed = conf_embed(ctx.guild, old_guild_conf, new_guild_conf)
+            embed.set_author(name=f'最大文字数を「{int_arg}」に変更しました．', icon_url=bot.user.avatar_url)
+            await asyncio.gather(
+                pg.set(ctx.guild, new_guild_conf),
+                ctx.send(embed=embed)
+            )
+
+
 @bot.event
 async def on_message(message:discord.Message):
-    
+    #設定の取得も含めた，メッセージを受け取ってから読み上げが始まるまでの時間を測る
+    received_at = time.perf_counter()
+
     #「help」だけはprefixによらず使用可能に
-    if (text:=message.content).startswith(pg.get_default('guild')['prefix'] + 'help'):
+    if (text:=message.content).startswith(default_prefix + 'help'):
         if message.guild is None:
             await message.channel.send('DMでの操作には対応していません．')
         else:
@@ -583,22 +759,25 @@ async def on_message(message:discord.Message):
     else:
         #サーバーごとのチェック
         guild_conf = await pg.fetch(message.guild)
-        if (guild_conf['target_ch'] != 'all') and (guild_conf['target_ch'] != str(message.channel.id)):
+        if (guild_conf.target_ch != 'all') and (guild_conf.target_ch != str(message.channel.id)):
             pass
-        elif (not guild_conf['read_outsider']) and ((message.author.voice is None) or (message.author.voice.channel is not message.guild.voice_client.channel)):
+        elif (not guild_conf.read_outsider) and ((message.author.voice is None) or (message.author.voice.channel is not message.guild.voice_client.channel)):
             pass
-        elif message.content.startswith(guild_conf['prefix']):
+        elif message.content.startswith(guild_conf.prefix):
             pass
-        #target_ch以外では反応しないようにサーバー毎でチェック
-        elif len(message.content) > 100:
-            await message.channel.send('文字数が多すぎます．')
 
         else:
             task = asyncio.create_task(pg.fetch(message.author))
-            text = await modify_text(message, guild_conf, bot)
-            text = my_normalizer(text)
+            with metrics.timer('modify_text_seconds'):
+                text = await modify_text(message, guild_conf, bot)
+            with metrics.timer('normalize_seconds'):
+                text = my_normalizer(text)
+            text = truncate_text(text, guild_conf.max_chars)
             voice_conf = await task
-            await read_text(text, voice_conf, message.guild.voice_client)
+            #文ごとに区切って積み，最初の文が合成できしだい再生を始める
+            #　遅延は最初の文が鳴り始めるまでを測るので，受け取った時刻は最初の文にだけ付ける
+            for i, chunk in enumerate(split_sentences(text)):
+                await read_text(chunk, voice_conf, message.guild.voice_client, received_at if i == 0 else None)
         
     await bot.process_commands(message)
 
@@ -611,17 +790,16 @@ async def on_voice_state_update(member:discord.Member, before:discord.VoiceClien
     if before.channel is None:
         if member.id == bot.user.id:
             logger.info(f'サーバー「{member.guild.name}」のVCに入室しました．')
-            presence = f'{default_prefix}help | {len(bot.voice_clients)}/{len(bot.guilds)}サーバー'
-            await bot.change_presence(activity=discord.Game(name=presence))
+            await cluster.update()
         else:
             if member.guild.voice_client is None:
-                if member.voice.self_mute and guild_conf['auto_join']:
+                if member.voice.self_mute and guild_conf.auto_join:
                     await asyncio.sleep(1)
                     await after.channel.connect()
-                    await play_wav('./wav/auto_join.wav', member.guild.voice_client)
+                    await play_cue('auto_join', member.guild.voice_client)
             else:
                 if member.guild.voice_client.channel is after.channel:
-                    if guild_conf['read_access']:
+                    if guild_conf.read_access:
                         text = my_normalizer(f'{member.name}さんが入室しました．')
                         await read_text(text, pg.get_default('user'), member.guild.voice_client)
     
@@ -629,25 +807,25 @@ async def on_voice_state_update(member:discord.Member, before:discord.VoiceClien
     elif after.channel is None:
         if member.id == bot.user.id:
             logger.info(f'サーバー「{member.guild.name}」のVCから退室しました．')
-            presence = f'{default_prefix}help | {len(bot.voice_clients)}/{len(bot.guilds)}サーバー'
-            await bot.change_presence(activity=discord.Game(name=presence))
+            close_player(member.guild)
+            await cluster.update()
         else:
             if member.guild.voice_client:
                 if member.guild.voice_client.channel is before.channel:
                     if len(member.guild.voice_client.channel.members) == 1:
                         await asyncio.sleep(1)
                         await member.guild.voice_client.disconnect()
-                    elif guild_conf['read_access']:
+                    elif guild_conf.read_access:
                         text = my_normalizer(f'{member.name}さんが退室しました．')
                         await read_text(text, pg.get_default('user'), member.guild.voice_client)
 
     #誰かが移動したとき
     elif before.channel is not after.channel:
         if member.guild.voice_client is None:
-            if member.voice.self_mute and guild_conf['auto_join']:
+            if member.voice.self_mute and guild_conf.auto_join:
                 await asyncio.sleep(1)
                 await after.channel.connect()
-                await play_wav('./wav/auto_join.wav', member.guild.voice_client)
+                await play_cue('auto_join', member.guild.voice_client)
         else:
             if member.guild.voice_client.channel is before.channel:
                 if len(member.guild.voice_client.channel.members) == 1:
@@ -656,9 +834,9 @@ async def on_voice_state_update(member:discord.Member, before:discord.VoiceClien
     
     #ミュートに変更したとき
     elif after.self_mute > before.self_mute:
-        if (member.guild.voice_client is None) and guild_conf['auto_join']:
+        if (member.guild.voice_client is None) and guild_conf.auto_join:
             await member.voice.channel.connect()
-            await play_wav('./wav/auto_join.wav', member.guild.voice_client)
+            await play_cue('auto_join', member.guild.voice_client)
 
 
 @bot.event
@@ -687,5 +865,7 @@ async def on_command_error(ctx:commands.Context, error:commands.CommandError):
 #ここまでbotの挙動
 ########################################################################################################
 
-logger.debug('botを起動しています．')
-bot.run(TOKEN)
+#benchmarks/loadsim.pyから読み込んだときは起動しない
+if __name__ == '__main__':
+    logger.debug('botを起動しています．')
+    bot.run(TOKEN)
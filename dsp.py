@@ -0,0 +1,149 @@
+"""合成済みの音声(48kHz・16bit・モノラルのPCM)にスピード変更とエフェクトをかける後処理．
+
+open_jtalkにスピードとエフェクトを渡すと設定ごとに合成し直しになるので，
+話者・感情・トーンが同じなら基準の音声を1回だけ合成し，違いはここで付ける．NumPyがなければ使えない．
+"""
+from typing import Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from audio import SAMPLING_RATE
+
+
+#スピード1段階あたりの速さの比(open_jtalkの-rと同じ)
+SPEED_STEP = 2**0.2
+#ロボット声の基本周波数(Hz)
+ROBOT_PITCH = 120
+#ささやき声で倍音を均す幅(Hz)
+WHISPER_SMOOTHING = 400
+
+
+def available() -> bool:
+    return np is not None
+
+
+def to_array(pcm:bytes) -> 'np.ndarray':
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768
+
+
+def to_pcm(x:'np.ndarray') -> bytes:
+    return np.clip(np.round(x * 32768), -32768, 32767).astype('<i2').tobytes()
+
+
+def rms(x:'np.ndarray') -> float:
+    return float(np.sqrt(np.mean(np.square(x, dtype=np.float64)))) if len(x) else 0.0
+
+
+def gain(x:'np.ndarray', db:float) -> 'np.ndarray':
+    return x * np.float32(10**(db / 20))
+
+
+def frames(x:'np.ndarray', size:int, hop:int) -> 'np.ndarray':
+    """窓の長さsizeをhopずつずらした(フレーム数, size)のビュー．端は無音で埋める．"""
+    n_frames = -(-len(x) // hop) + size // hop - 1
+    padded = np.zeros((n_frames - 1) * hop + size, dtype=np.float32)
+    padded[size - hop:size - hop + len(x)] = x
+    return np.lib.stride_tricks.sliding_window_view(padded, size)[::hop]
+
+
+def overlap_add(blocks:'np.ndarray', hop:int, length:int) -> 'np.ndarray':
+    """framesの逆．窓の長さはhopの整数倍で，重なりの段数ごとにまとめて足す．"""
+    n_frames, size = blocks.shape
+    out = np.zeros((n_frames + size // hop - 1) * hop, dtype=np.float32)
+    for j in range(size // hop):
+        out[j * hop:(j + n_frames) * hop] += blocks[:, j * hop:(j + 1) * hop].reshape(-1)
+    return out[size - hop:size - hop + length]
+
+
+def hann(size:int) -> 'np.ndarray':
+    return (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / size)).astype(np.float32)
+
+
+def time_stretch(x:'np.ndarray', rate:float, size:int=1920, tolerance:int=480, decimation:int=8) -> 'np.ndarray':
+    """WSOLAで音の高さを変えずに長さを1/rateにする．
+
+    読み出し位置の前後toleranceサンプルから，前のフレームをそのまま続けた場合と最も相関が高い位置を選んで重ね合わせる．
+    相関はdecimationサンプルおきに間引いて求める．
+    """
+    if (rate == 1) or (len(x) == 0):
+        return x
+    hop = size // 2
+    length = int(round(len(x) / rate))
+    n_frames = -(-length // hop) + 1
+    #出力のフレームkは，入力の (k * hop - (size - hop)) * rate あたりから読む
+    offset = tolerance + int(np.ceil((size - hop) * rate))
+    padded = np.concatenate([np.zeros(offset, np.float32), x, np.zeros(int(n_frames * hop * rate) + size + 2 * tolerance, np.float32)])
+    targets = (offset + (np.arange(n_frames) * hop - (size - hop)) * rate).astype(np.int64)
+    positions = targets.copy()
+    for k in range(1, n_frames):
+        natural = positions[k - 1] + hop
+        template = padded[natural:natural + hop:decimation]
+        if not np.any(template):
+            continue
+        start = targets[k] - tolerance
+        correlation = np.correlate(padded[start:start + 2 * tolerance + hop:decimation], template, 'valid')
+        positions[k] = start + int(np.argmax(correlation)) * decimation
+    w = hann(size)
+    blocks = padded[positions[:, None] + np.arange(size)] * (w * np.float32(hop / np.sum(w)))
+    return overlap_add(blocks, hop, length)
+
+
+def stft(x:'np.ndarray', size:int, hop:int) -> 'np.ndarray':
+    return np.fft.rfft(frames(x, size, hop) * hann(size), axis=1)
+
+
+def istft(spectrum:'np.ndarray', size:int, hop:int, length:int) -> 'np.ndarray':
+    #分析と合成で2回かけた窓の重なりの和が1になるようにする
+    w = hann(size)
+    blocks = np.fft.irfft(spectrum, size, axis=1).astype(np.float32) * (w * np.float32(hop / np.sum(np.square(w))))
+    return overlap_add(blocks, hop, length)
+
+
+def robot(x:'np.ndarray', pitch:float=ROBOT_PITCH) -> 'np.ndarray':
+    """位相を捨ててpitchの周期で振幅スペクトルだけを並べ直し，一定の高さの機械的な声にする．"""
+    hop = int(SAMPLING_RATE / pitch)
+    size = hop * 4
+    spectrum = np.abs(stft(x, size, hop))
+    #位相0のままだとパルスが窓の端に来るので中央にずらす
+    spectrum = spectrum * np.where(np.arange(spectrum.shape[1]) % 2 == 0, 1, -1)
+    return istft(spectrum, size, hop, len(x))
+
+
+def whisper(x:'np.ndarray', smoothing:float=WHISPER_SMOOTHING, seed:int=0) -> 'np.ndarray':
+    """振幅スペクトルを周波数方向に均して倍音をなくし，位相をランダムにして息だけの声にする．"""
+    size, hop = 1024, 256
+    magnitude = np.abs(stft(x, size, hop))
+    width = max(int(smoothing * size / SAMPLING_RATE), 1)
+    #周波数方向の移動平均(パワーで)
+    power = np.pad(np.square(magnitude), ((0, 0), (width, width)), mode='edge')
+    cumsum = np.cumsum(power, axis=1)
+    envelope = np.sqrt((cumsum[:, 2 * width:] - cumsum[:, :-2 * width]) / (2 * width))
+    phase = np.random.default_rng(seed).uniform(-np.pi, np.pi, envelope.shape)
+    return istft(envelope * np.exp(1j * phase), size, hop, len(x))
+
+
+def process(pcm:bytes, speed:str='0', effect:str='none', gain_db:float=0.0) -> bytes:
+    """基準(スピード0・エフェクトなし)で合成したPCMに，スピードとエフェクトと音量の変更をかける．
+
+    エフェクトで変わった音量は元の音量にそろえてからgain_dbをかける．
+    """
+    x = to_array(pcm)
+    level = rms(x)
+    x = time_stretch(x, SPEED_STEP**int(speed))
+    if effect == 'robot':
+        x = robot(x)
+    elif effect == 'whisper':
+        x = whisper(x)
+    if (effect != 'none') and (level > 0) and ((new_level := rms(x)) > 0):
+        x = gain(x, 20 * np.log10(level / new_level))
+    if gain_db != 0:
+        x = gain(x, gain_db)
+    return to_pcm(x)
+
+
+def base_voice(speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Tuple[str, ...]:
+    """後処理で作れる設定を除いた，基準の合成に使うボイス設定．"""
+    return (speaker, emotion, 'none', tone, '0')
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import signal
+import sys
+from typing import Dict, List
+
+import discord
+from dotenv import load_dotenv
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+load_dotenv()
+TOKEN = os.environ['TOKEN']
+#シャード数（未設定ならDiscordの推奨値）と1プロセスあたりのシャード数
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT') or 0) or None
+SHARDS_PER_PROCESS = int(os.environ.get('SHARDS_PER_PROCESS') or 1)
+
+
+async def recommended_shard_count() -> int:
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(TOKEN, bot=True)
+        shard_count, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shard_count
+
+
+def shard_ranges(shard_count:int, shards_per_process:int) -> List[List[int]]:
+    return [list(range(i, min(i + shards_per_process, shard_count))) for i in range(0, shard_count, shards_per_process)]
+
+
+class Launcher:
+    """シャードを分けてdiscordbot.pyを複数のプロセスで起動し，異常終了したものを起動し直す．
+
+    各プロセスはそれぞれPostgresの接続とopen_jtalkのワーカーを持つ．
+    正常に終了した(shutdownコマンドなど)プロセスは起動し直さない．
+    """
+    def __init__(self, shard_count:int, shards_per_process:int) -> None:
+        self.shard_count = shard_count
+        self.ranges = shard_ranges(shard_count, shards_per_process)
+        self.procs: Dict[int, asyncio.subprocess.Process] = {}
+        self.closing = False
+
+
+    def env(self, index:int) -> Dict[str, str]:
+        env = {**os.environ, 'SHARD_COUNT': str(self.shard_count), 'SHARD_IDS': ','.join(map(str, self.ranges[index]))}
+        #メトリクスのポートはプロセスごとにずらす
+        if os.environ.get('METRICS_PORT'):
+            env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+        #合成ワーカーはCPUをプロセスで分け合う
+        if not os.environ.get('TTS_CONCURRENCY'):
+            env['TTS_CONCURRENCY'] = str(max(1, (os.cpu_count() or 1) // len(self.ranges)))
+        return env
+
+
+    async def supervise(self, index:int) -> None:
+        shard_ids = self.ranges[index]
+        delay = 1
+        while not self.closing:
+            proc = self.procs[index] = await asyncio.create_subprocess_exec(sys.executable, 'discordbot.py', env=self.env(index))
+            logger.info(f'シャード{shard_ids}のプロセスを起動しました．(pid: {proc.pid})')
+            returncode = await proc.wait()
+            if self.closing or (returncode == 0):
+                logger.info(f'シャード{shard_ids}のプロセスが終了しました．')
+                return
+            logger.error(f'シャード{shard_ids}のプロセスが異常終了しました．{delay}秒後に起動し直します．(code: {returncode})')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+    def stop(self) -> None:
+        self.closing = True
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, self.stop)
+        logger.info(f'{self.shard_count}個のシャードを{len(self.ranges)}個のプロセスで起動します．')
+        await asyncio.gather(*[self.supervise(index) for index in range(len(self.ranges))])
+
+
+async def main() -> None:
+    shard_count = SHARD_COUNT or await recommended_shard_count()
+    await Launcher(shard_count, SHARDS_PER_PROCESS).run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
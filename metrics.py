@@ -0,0 +1,190 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from aiohttp import web
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+#秒単位の区切り(Prometheusのle)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """区切りごとの件数と，パーセンタイル用に直近reservoir件の値を持つ．"""
+    def __init__(self, buckets:Tuple[float, ...]=BUCKETS, reservoir:int=2048) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=reservoir)
+
+    def observe(self, value:float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantile(self, q:float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Metrics:
+    """読み上げの各段階の所要時間と件数を集計する．
+
+    observe/timerで所要時間のヒストグラムに，incでカウンターに記録し，
+    renderでPrometheusのテキスト形式に書き出す．ラベルはキーワード引数で渡す．
+    待ち行列の深さなどその時点の値は，gaugeで登録したstatsを書き出すたびに呼んで集める．
+    """
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, int]] = {}
+        self.gauges: Dict[str, Callable[[], dict]] = {}
+        self.help: Dict[str, str] = {}
+
+
+    def describe(self, name:str, help:str) -> None:
+        self.help[name] = help
+
+
+    def observe(self, name:str, value:float, **labels:str) -> None:
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        if (histogram := series.get(key)) is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+
+    def inc(self, name:str, value:int=1, **labels:str) -> None:
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        series[key] = series.get(key, 0) + value
+
+
+    def gauge(self, prefix:str, stats:Callable[[], dict]) -> None:
+        """statsが返す辞書の数値を prefix_キー のゲージにする．入れ子の辞書はキーを_でつなぐ．"""
+        self.gauges[prefix] = stats
+
+
+    def collect(self) -> List[Tuple[str, float]]:
+        #登録したstatsを呼んで(名前, 値)を並べる
+        rows = []
+        def walk(name:str, stats:dict) -> None:
+            for k, v in stats.items():
+                if isinstance(v, dict):
+                    walk(f'{name}_{k}', v)
+                elif isinstance(v, (int, float)):
+                    #boolは0/1にする
+                    rows.append((f'{name}_{k}', int(v) if isinstance(v, bool) else v))
+        for prefix, stats in sorted(self.gauges.items()):
+            try:
+                walk(prefix, stats())
+            except Exception as error:
+                logger.error(f'{prefix}の値を集められませんでした．({error.__class__.__name__}: {error})')
+        return rows
+
+
+    @contextmanager
+    def timer(self, name:str, **labels:str) -> Iterator[dict]:
+        #with内で labels['result'] = 'hit' のように後からラベルを足せる
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def percentiles(self) -> List[Tuple[str, Labels, int, float, float, float]]:
+        rows = []
+        for name, series in sorted(self.histograms.items()):
+            for labels, histogram in sorted(series.items()):
+                rows.append((name, labels, histogram.count, histogram.quantile(0.5), histogram.quantile(0.95), histogram.quantile(0.99)))
+        return rows
+
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in sorted(series.items()):
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        for name, series in sorted(self.histograms.items()):
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for name, value in sorted(self.collect()):
+            if name in self.help:
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+    async def serve(self, host:str, port:int) -> web.AppRunner:
+        async def handle(request:web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type='text/plain')
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f'メトリクスを http://{host}:{port}/metrics で公開しました．')
+        return runner
+
+
+def format_labels(labels:Labels) -> str:
+    if not labels:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join([f'{k}="{v}"' for k, v in escaped]) + '}'
+
+
+metrics = Metrics()
+metrics.describe('modify_text_seconds', 'メンションや絵文字などの置き換えにかかった時間')
+metrics.describe('normalize_seconds', 'my_normalizerにかかった時間')
+metrics.describe('config_fetch_seconds', 'Postgres.fetchにかかった時間')
+metrics.describe('synthesis_seconds', '合成の依頼から音声ができるまでの時間')
+metrics.describe('openjtalk_seconds', 'open_jtalkの実行時間')
+metrics.describe('openjtalk_spare_total', '起動済みのopen_jtalkを使えたか')
+metrics.describe('opus_encode_seconds', '合成した音声をOpusに符号化する時間')
+metrics.describe('dsp_seconds', '基準の音声にスピードとエフェクトを付ける後処理の時間')
+metrics.describe('playback_wait_seconds', '再生キューに入ってから再生が始まるまでの時間')
+metrics.describe('message_to_audio_seconds', 'メッセージを受け取ってから読み上げが始まるまでの時間')
+metrics.describe('config_cache_total', '設定キャッシュの参照結果')
+metrics.describe('audio_cache_total', '合成音声キャッシュの参照結果')
+metrics.describe('synthesis_failures_total', '合成できなかった件数')
+metrics.describe('openjtalk_exit_total', 'open_jtalkの終了コード')
+metrics.describe('dropped_messages_total', '読み上げずに破棄したメッセージ')
+metrics.describe('scheduler_queued', '合成を待っている件数')
+metrics.describe('scheduler_inflight', '合成中の件数')
+metrics.describe('scheduler_avg_wait', '合成が始まるまでの平均の待ち時間(秒)')
@@ -0,0 +1,159 @@
+import asyncio
+import time
+import discord
+from typing import Tuple, Union
+
+from audio import audio_source
+from scheduler import SynthesisScheduler, Overloaded
+from utils import UserConf
+from metrics import metrics
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+class GuildPlayer:
+    """サーバーごとの再生キュー．
+
+    renderタスクがキューの先頭からlookahead件まで先に合成を始めておき，
+    consumeタスクが順に再生してVoiceClient.playのafterで再生終了を受け取ったらすぐに次へ進む．
+    先読みした音声の合計がmax_buffered_bytesを超える間は次の合成を始めない．
+    """
+    def __init__(self, voice_client:discord.VoiceClient, scheduler:SynthesisScheduler, lookahead:int=2, max_buffered_bytes:int=8 * 2**20) -> None:
+        self.voice_client = voice_client
+        self.scheduler = scheduler
+        self.queue = asyncio.Queue()
+        #同時に合成する件数．合成を始める前に枠を取っておき，consumeが合成の終わりを受け取ったら返す
+        self.slots = asyncio.Semaphore(max(lookahead, 1))
+        self.ready = asyncio.Queue()
+        self.max_buffered_bytes = max_buffered_bytes
+        self.n_buffered = 0
+        self.buffered = asyncio.Condition()
+        #renderがqueueから取り出してまだreadyに入れていないもの(closeで取りこぼさないように持っておく)
+        self.taken = None
+        self.tasks = [asyncio.create_task(self.render()), asyncio.create_task(self.consume())]
+
+
+    def enqueue_text(self, text:str, voice_conf:UserConf, received_at:float=None) -> asyncio.Future:
+        return self.enqueue(text, voice_conf, None, received_at)
+
+
+    def enqueue_audio(self, pcm:bytes) -> asyncio.Future:
+        #PCMでもencode_opusで符号化したものでもよい
+        return self.enqueue(None, None, pcm, None)
+
+
+    def enqueue(self, text:Union[str, None], voice_conf:Union[UserConf, None], pcm:Union[bytes, None], received_at:Union[float, None]) -> asyncio.Future:
+        #再生し終えたらTrue，再生できなかったらFalseが入る
+        done = asyncio.get_running_loop().create_future()
+        #待ち時間の計測用に積んだ時刻とメッセージを受け取った時刻を持たせる
+        times = (time.perf_counter(), received_at)
+        self.queue.put_nowait((text, voice_conf, pcm, done, times))
+        return done
+
+
+    def qsize(self) -> int:
+        return self.queue.qsize() + self.ready.qsize()
+
+
+    async def render(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self.taken = await self.queue.get()
+            text, voice_conf, pcm, done, times = self.taken
+            #先読み済みの音声が多すぎる間は待つ
+            async with self.buffered:
+                await self.buffered.wait_for(lambda: self.n_buffered < self.max_buffered_bytes)
+            await self.slots.acquire()
+            if pcm is None:
+                rendering = asyncio.create_task(self.scheduler.submit(self.voice_client.guild.id, text, voice_conf))
+                rendering.add_done_callback(self.on_rendered)
+            else:
+                rendering = loop.create_future()
+                rendering.set_result(pcm)
+                self.n_buffered += len(pcm)
+            self.ready.put_nowait((rendering, done, times))
+            self.taken = None
+
+
+    def on_rendered(self, rendering:asyncio.Future) -> None:
+        if (not rendering.cancelled()) and (rendering.exception() is None) and (rendering.result() is not None):
+            self.n_buffered += len(rendering.result())
+
+
+    async def release(self, pcm:bytes) -> None:
+        async with self.buffered:
+            self.n_buffered -= len(pcm)
+            self.buffered.notify_all()
+
+
+    async def consume(self) -> None:
+        while True:
+            rendering, done, times = await self.ready.get()
+            await asyncio.wait([rendering])
+            self.slots.release()
+            played = False
+            pcm = None
+            try:
+                if (pcm := await rendering) is not None:
+                    await self.play(pcm, times)
+                    played = True
+            except Overloaded:
+                metrics.inc('dropped_messages_total', reason='overloaded')
+            except (discord.ClientException, AttributeError):
+                pass
+            except Exception as error:
+                logger.error(f'{error.__class__.__name__}: {error}')
+            finally:
+                if pcm is not None:
+                    await self.release(pcm)
+                if not done.done():
+                    done.set_result(played)
+
+
+    async def play(self, pcm:bytes, times:Tuple[float, Union[float, None]]) -> None:
+        loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+        def after(error:Union[Exception, None]) -> None:
+            #afterは音声スレッドから呼ばれる
+            if error is not None:
+                logger.error(f'{error.__class__.__name__}: {error}')
+            loop.call_soon_threadsafe(finished.set)
+        self.voice_client.play(audio_source(pcm), after=after)
+        enqueued_at, received_at = times
+        now = time.perf_counter()
+        metrics.observe('playback_wait_seconds', now - enqueued_at)
+        if received_at is not None:
+            metrics.observe('message_to_audio_seconds', now - received_at)
+        await finished.wait()
+
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        n_dropped = 0
+        while not self.ready.empty():
+            rendering, done, _ = self.ready.get_nowait()
+            rendering.cancel()
+            n_dropped += 1
+            if not done.done():
+                done.set_result(False)
+        taken = [] if self.taken is None else [self.taken]
+        self.taken = None
+        while not self.queue.empty():
+            taken.append(self.queue.get_nowait())
+        for *_, done, _ in taken:
+            n_dropped += 1
+            if not done.done():
+                done.set_result(False)
+        if n_dropped > 0:
+            metrics.inc('dropped_messages_total', n_dropped, reason='closed')
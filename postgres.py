@@ -1,9 +1,13 @@
+import asyncio
 import asyncpg
+import json
+import time
+import uuid
 from collections import OrderedDict
-from copy import deepcopy
-from typing import Literal, Union
+from typing import Dict, List, Literal, Tuple, Union
 import discord
-from utils import random_voice
+from utils import UserConf, GuildConf, random_voice
+from metrics import metrics
 
 from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
 
@@ -18,21 +22,13 @@ hdlr.setFormatter(fmt)
 logger.addHandler(hdlr)
 
 DEFAULT = {
-    'user': {
-        'speaker': 'mei',
-        'emotion': 'normal',
-        'effect': 'none',
-        'tone': '0',
-        'speed': '0'
-    },
-    'guild': {
-        'prefix': ';',
-        'target_ch': 'all',
-        'auto_join': True,
-        'read_access': True,
-        'read_author': False,
-        'read_outsider': False,
-    }
+    'user': UserConf(),
+    'guild': GuildConf()
+}
+
+CONF_TYPE = {
+    'user': UserConf,
+    'guild': GuildConf
 }
 
 CACHE_SIZE = {
@@ -40,42 +36,80 @@ CACHE_SIZE = {
     'guild': 50
 }
 
+#設定の変更を他のプロセスに知らせるチャンネル
+NOTIFY_CHANNEL = 'shaberina_conf'
+
+#読み込みに失敗した設定は，この秒数の間DBに問い合わせずに同じエラーを返す
+ERROR_TTL = 2.0
+
 
 class LRUCache:
+    """設定のキャッシュ．設定は変更不可なのでコピーせずにそのまま渡す．"""
     def __init__(self, name:str, size:int) -> None:
         self.body = OrderedDict()
         self.name = name
         self.size = size
         self.is_full = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
-    def get(self, key:str) -> dict:
+    def get(self, key:str) -> Union[UserConf, GuildConf, None]:
         if key not in self.body:
+            self.misses += 1
             return None
         else:
             self.body.move_to_end(key)
-            return deepcopy(self.body[key])
+            self.hits += 1
+            return self.body[key]
 
-    def put(self, key:str, value:dict) -> None:
+    def put(self, key:str, value:Union[UserConf, GuildConf]) -> None:
         #空きがあるとき
         if not self.is_full:
             if key in self.body:
                 del self.body[key]
-                self.body[key] = deepcopy(value)
+                self.body[key] = value
             else:
-                self.body[key] = deepcopy(value)
+                self.body[key] = value
                 logger.debug(f'キャッシュに{self.name}データを保存しました．({len(self.body)}/{self.size})')
             #キャッシュがいっぱいになったとき
-            if len(self.body) == self.size:
+            if len(self.body) >= self.size:
                 self.is_full = True
                 logger.warning(f'{self.name}データのキャッシュ上限に達しました．容量を確認してください．({len(self.body)}/{self.size})')
         #キャッシュがいっぱいのとき
         else:
             if key in self.body:
                 del self.body[key]
-                self.body[key] = deepcopy(value)
+                self.body[key] = value
             else:
                 self.body.popitem(last=False)
-                self.body[key] = deepcopy(value)
+                self.evictions += 1
+                self.body[key] = value
+
+    def resize(self, size:int) -> None:
+        self.size = size
+        while len(self.body) > self.size:
+            self.body.popitem(last=False)
+            self.evictions += 1
+        self.is_full = len(self.body) >= self.size
+        logger.info(f'{self.name}データのキャッシュ容量を{self.size}件にしました．')
+
+    def clear(self) -> None:
+        self.body.clear()
+        self.is_full = False
+
+    def peek(self, key:str) -> Union[UserConf, GuildConf, None]:
+        #順番も統計も変えずに中身だけ見る
+        return self.body.get(key)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.body),
+            'capacity': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
 
 
 
@@ -84,53 +118,232 @@ def vind_str(n:int) -> str:
 
 
 class Postgres:
-    def __init__(self, URL:str) -> None:
+    """設定の読み書き．
+
+    write_behind(秒)を指定すると，setはキャッシュだけを更新して変更を溜めておき，
+    その間隔ごと(とdisconnect時)に変わった列だけをまとめてUPDATEする．
+    listenがTrueのときは，書き込んだ設定をNOTIFYで流し，他のプロセスからの通知でキャッシュを更新する．
+    """
+    def __init__(self, URL:str, cache_size:Dict[str, int]=None, write_behind:float=0, listen:bool=True, pool_size:Tuple[int, int]=(2, 8), timeout:float=None) -> None:
         self.URL = URL
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.write_behind = write_behind
+        self.listen = listen
+        #自分が送った通知を見分けるためのプロセスごとのid
+        self.origin = uuid.uuid4().hex
+        self.pool = None
+        self.listener = None
+        self.closing = False
+        #LISTENするチャンネル -> 通知を受け取る関数
+        self.subscriptions = {NOTIFY_CHANNEL: self.on_notify} if listen else {}
+        #書き込み待ちの設定 id -> (最後に書き込んだ設定, 最新の設定)
+        self.dirty: Dict[str, Dict[str, Tuple[Union[UserConf, GuildConf, None], Union[UserConf, GuildConf]]]] = {'user': {}, 'guild': {}}
+        self.flusher = None
+        #読み込み中の設定 (mode, id) -> Task．同じ設定を同時に読むときは1回の問い合わせを共有する
+        self.loading: Dict[Tuple[str, str], asyncio.Task] = {}
+        #直近に読み込みに失敗した設定 (mode, id) -> (時刻, エラー)
+        self.failures: Dict[Tuple[str, str], Tuple[float, Exception]] = {}
+        self.n_coalesced = 0
+        cache_size = {**CACHE_SIZE, **(cache_size or {})}
         self.cache = {
-            'user': LRUCache('ユーザー', CACHE_SIZE['user']),
-            'guild': LRUCache('サーバー', CACHE_SIZE['guild'])
+            'user': LRUCache('ユーザー', cache_size['user']),
+            'guild': LRUCache('サーバー', cache_size['guild'])
         }
-        self.default = deepcopy(DEFAULT)
+        self.default = DEFAULT
         self.params = {
-            'user': list(self.default['user'].keys()),
-            'guild': list(self.default['guild'].keys())
+            'user': list(UserConf._fields),
+            'guild': list(GuildConf._fields)
         }
         self.n_param = {
             'user': len(self.params['user']),
             'guild': len(self.params['guild'])
         }
+        #クエリは一度だけ組み立てる．asyncpgが接続ごとにプリペアドステートメントとしてキャッシュする
+        self.queries = {mode: self.build_queries(mode) for mode in ['user', 'guild']}
+        self.update_queries: Dict[Tuple[str, Tuple[str, ...]], str] = {}
+
+
+    def build_queries(self, mode:Literal['user', 'guild']) -> Dict[str, str]:
+        columns = ', '.join(self.params[mode])
+        n_param = self.n_param[mode]
+        return {
+            'select': f'SELECT {columns} FROM {mode}s WHERE id = $1;',
+            'update': f'UPDATE {mode}s SET ({columns}) = ({vind_str(n_param)}) WHERE id = ${n_param + 1};',
+            #登録済みならその設定を，未登録なら登録した設定を1往復で返す
+            #　同時に登録された場合はどちらも返らないことがあるので，そのときはselectで読み直す
+            #　列の順番がテーブルごとに違っても(ALTER TABLEで足した列など)ずれないように列名を書く
+            'upsert': (
+                f'WITH ins AS (INSERT INTO {mode}s (id, name, {columns}) VALUES ({vind_str(n_param + 2)}) ON CONFLICT DO NOTHING RETURNING {columns}) '
+                f'SELECT TRUE AS created, {columns} FROM ins '
+                f'UNION ALL SELECT FALSE AS created, {columns} FROM {mode}s WHERE id = $1 '
+                f'LIMIT 1;'
+            ),
+            'preload': f'SELECT id, {columns} FROM {mode}s WHERE id = ANY($1::text[]);'
+        }
+
+
+    def update_query(self, mode:Literal['user', 'guild'], columns:Tuple[str, ...]) -> str:
+        #変わった列だけを書き込むクエリ．列の組み合わせごとに使い回す
+        if (query := self.update_queries.get((mode, columns))) is None:
+            assignments = ', '.join([f'{param} = ${i}' for i, param in enumerate(columns, 1)])
+            query = self.update_queries[(mode, columns)] = f'UPDATE {mode}s SET {assignments} WHERE id = ${len(columns) + 1};'
+        return query
     
 
-    def get_default(self, mode:Literal['user', 'guild']) -> dict:
-        return deepcopy(self.default[mode])
+    def get_default(self, mode:Literal['user', 'guild']) -> Union[UserConf, GuildConf]:
+        return self.default[mode]
+
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {mode: {**cache.stats(), 'dirty': len(self.dirty[mode])} for mode, cache in self.cache.items()}
+        stats['loading'] = {'inflight': len(self.loading), 'coalesced': self.n_coalesced, 'failing': len(self.failures)}
+        return stats
 
 
     async def connect(self) -> None:
-        self.pool = await asyncpg.create_pool(dsn=self.URL, min_size=2, max_size=8)
+        #接続済みなら何もしない(プールや通知の受信を二重に作らない)
+        if self.pool is not None:
+            return
+        min_size, max_size = self.pool_size
+        #timeoutはクライアント側の待ち時間とサーバー側のstatement_timeoutの両方に使う
+        server_settings = {'statement_timeout': str(int(self.timeout * 1000))} if self.timeout else None
+        self.pool = await asyncpg.create_pool(dsn=self.URL, min_size=min_size, max_size=max_size, command_timeout=self.timeout, server_settings=server_settings)
+        if self.write_behind > 0:
+            self.flusher = asyncio.create_task(self.flush_loop())
+        if self.subscriptions:
+            await self.start_listener()
         logger.info('Postgresとの接続に成功しました．')
 
 
-    async def fetch(self, obj:Union[discord.Member, discord.Guild]) -> dict:
+    async def start_listener(self) -> None:
+        self.listener = await asyncpg.connect(dsn=self.URL)
+        self.listener.add_termination_listener(self.on_listener_lost)
+        for channel, callback in self.subscriptions.items():
+            await self.listener.add_listener(channel, callback)
+
+
+    async def subscribe(self, channel:str, callback) -> None:
+        """設定以外の通知も同じLISTEN用の接続で受け取る．接続前に登録したものはconnectで購読を始める．
+
+        listenがFalseでLISTEN用の接続がまだなければ，ここで接続する．
+        """
+        self.subscriptions[channel] = callback
+        if self.listener is not None:
+            await self.listener.add_listener(channel, callback)
+        elif self.pool is not None:
+            await self.start_listener()
+
+
+    async def publish(self, channel:str, payload:str) -> None:
+        async with self.pool.acquire() as con:
+            await con.execute('SELECT pg_notify($1, $2);', channel, payload)
+
+
+    def on_listener_lost(self, con:asyncpg.Connection) -> None:
+        if self.closing:
+            return
+        #切れている間の通知は届かないので，キャッシュを捨ててから繋ぎ直す
+        logger.warning('変更通知の受信が切断されたため，設定キャッシュを破棄して再接続します．')
+        for cache in self.cache.values():
+            cache.clear()
+        asyncio.create_task(self.reconnect_listener())
+
+
+    async def reconnect_listener(self) -> None:
+        delay = 1
+        while not self.closing:
+            try:
+                await self.start_listener()
+                #繋ぎ直すまでの間にfetchでキャッシュに載せた設定には，その間の変更が届いていない
+                for cache in self.cache.values():
+                    cache.clear()
+                logger.info('変更通知の受信を再開しました．')
+                return
+            except Exception as error:
+                logger.error(f'{error.__class__.__name__}: {error}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+
+    def payload(self, mode:Literal['user', 'guild'], id:str, conf:Union[UserConf, GuildConf]) -> str:
+        return json.dumps({'origin': self.origin, 'mode': mode, 'id': id, 'conf': list(conf)}, ensure_ascii=False)
+
+
+    def on_notify(self, con:asyncpg.Connection, pid:int, channel:str, payload:str) -> None:
+        try:
+            event = json.loads(payload)
+            mode, id = event['mode'], event['id']
+            conf = CONF_TYPE[mode](*event['conf'])
+        except Exception as error:
+            logger.error(f'不正な変更通知を受け取りました．({error.__class__.__name__}: {error})')
+            return
+        if event['origin'] == self.origin:
+            return
+        #書き込み待ちの設定があれば後でそちらが書き込まれるので，そのままにする
+        if id in self.dirty[mode]:
+            return
+        #キャッシュに載っているものだけ差し替える
+        if self.cache[mode].peek(id) is not None:
+            self.cache[mode].put(id, conf)
+            logger.debug(f'他のプロセスで更新された{self.cache[mode].name}データを反映しました．(id: {id})')
+
+
+    async def fetch(self, obj:Union[discord.Member, discord.Guild]) -> Union[UserConf, GuildConf]:
         id = str(obj.id)
         if isinstance(obj,discord.Member):
             mode = 'user'
         elif isinstance(obj, discord.Guild):
             mode = 'guild'
         
+        with metrics.timer('config_fetch_seconds', mode=mode, result='hit') as labels:
+            return await self.fetch_conf(obj, mode, id, labels)
+
+
+    async def fetch_conf(self, obj:Union[discord.Member, discord.Guild], mode:Literal['user', 'guild'], id:str, labels:dict) -> Union[UserConf, GuildConf]:
         if (conf := self.cache[mode].get(id)) is not None:
+            metrics.inc('config_cache_total', mode=mode, result='hit')
             return conf
-        else:
-            async with self.pool.acquire() as con:
-                query = f'SELECT {", ".join(self.params[mode])} FROM {mode}s WHERE id = $1;'
-                if (resp := await con.fetchrow(query, id)) is not None:
-                    conf = dict(resp)
-                else:
-                    conf = await self.create_record(obj)
+        #書き込み前にキャッシュから追い出された設定はDBより新しい
+        elif id in self.dirty[mode]:
+            metrics.inc('config_cache_total', mode=mode, result='hit')
+            conf = self.dirty[mode][id][1]
             self.cache[mode].put(id, conf)
             return conf
+        else:
+            labels['result'] = 'miss'
+            metrics.inc('config_cache_total', mode=mode, result='miss')
+            key = (mode, id)
+            if (failure := self.failures.get(key)) is not None:
+                if time.monotonic() - failure[0] < ERROR_TTL:
+                    raise failure[1]
+                del self.failures[key]
+            if (task := self.loading.get(key)) is None:
+                task = self.loading[key] = asyncio.create_task(self.create_record(obj))
+                task.add_done_callback(lambda task: self.on_loaded(key, task))
+            else:
+                self.n_coalesced += 1
+            #待っている側が取り消されても問い合わせは止めない
+            conf = await asyncio.shield(task)
+            return self.cache[mode].peek(id) or conf
+
+
+    def on_loaded(self, key:Tuple[str, str], task:asyncio.Task) -> None:
+        mode, id = key
+        del self.loading[key]
+        if task.cancelled():
+            return
+        elif (error := task.exception()) is not None:
+            now = time.monotonic()
+            self.failures = {k: v for k, v in self.failures.items() if now - v[0] < ERROR_TTL}
+            self.failures[key] = (now, error)
+            logger.error(f'{self.cache[mode].name}データの読み込みに失敗しました．(id: {id}, {error.__class__.__name__}: {error})')
+        #読み込んでいる間にsetや変更通知で入った設定の方が新しい
+        elif (self.cache[mode].peek(id) is None) and (id not in self.dirty[mode]):
+            self.cache[mode].put(id, task.result())
     
 
-    async def set(self, obj:Union[discord.Member, discord.Guild], conf:dict) -> None:
+    async def set(self, obj:Union[discord.Member, discord.Guild], conf:Union[UserConf, GuildConf]) -> None:
         id = str(obj.id)
         name = obj.name
         if isinstance(obj, discord.Member):
@@ -140,14 +353,74 @@ class Postgres:
             mode = 'guild'
             display_mode = 'サーバー'
         
+        if self.write_behind > 0:
+            #書き込みは後でまとめて行う．最初に書き込み待ちになったときの設定を差分の基準にする
+            if id in self.dirty[mode]:
+                base = self.dirty[mode][id][0]
+            else:
+                base = self.cache[mode].peek(id)
+            self.dirty[mode][id] = (base, conf)
+            self.cache[mode].put(id, conf)
+            logger.info(f'{display_mode}「{name}」のデータを更新しました．(書き込み待ち)')
+            return
+
         async with self.pool.acquire() as con:
-            query = f'UPDATE {mode}s SET ({", ".join(self.params[mode])}) = ({vind_str(self.n_param[mode])}) WHERE id = ${self.n_param[mode] + 1};'
-            await con.execute(query, *conf.values(), id)
+            async with con.transaction():
+                await con.execute(self.queries[mode]['update'], *conf, id)
+                if self.listen:
+                    await con.execute('SELECT pg_notify($1, $2);', NOTIFY_CHANNEL, self.payload(mode, id, conf))
         self.cache[mode].put(id, conf)
         logger.info(f'{display_mode}「{name}」のデータを更新しました．')
 
 
-    async def create_record(self, obj:Union[discord.Member, discord.Guild]) -> dict:
+    async def flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.write_behind)
+            await self.flush()
+
+
+    async def flush(self) -> None:
+        """書き込み待ちの設定を変わった列ごとにまとめてUPDATEする．失敗したら次回に持ち越す．"""
+        for mode in ['user', 'guild']:
+            if not self.dirty[mode]:
+                continue
+            dirty, self.dirty[mode] = self.dirty[mode], {}
+            #変わった列の組み合わせが同じ行を1回のexecutemanyにまとめる
+            groups: Dict[Tuple[str, ...], List[tuple]] = {}
+            for id, (base, conf) in dirty.items():
+                if base is None:
+                    columns = self.params[mode]
+                else:
+                    columns = [param for param in self.params[mode] if getattr(base, param) != getattr(conf, param)]
+                if not columns:
+                    continue
+                groups.setdefault(tuple(columns), []).append((*[getattr(conf, param) for param in columns], id))
+            try:
+                async with self.pool.acquire() as con:
+                    async with con.transaction():
+                        for columns, rows in groups.items():
+                            await con.executemany(self.update_query(mode, columns), rows)
+                        #通知はコミット時にまとめて送られる
+                        if self.listen and groups:
+                            await con.executemany('SELECT pg_notify($1, $2);', [(NOTIFY_CHANNEL, self.payload(mode, row[-1], dirty[row[-1]][1])) for rows in groups.values() for row in rows])
+            except BaseException as error:
+                #書き込めなかった分を戻す．この間にsetされていたらそちらの設定を優先する
+                for id, (base, conf) in dirty.items():
+                    if id in self.dirty[mode]:
+                        self.dirty[mode][id] = (base, self.dirty[mode][id][1])
+                    else:
+                        self.dirty[mode][id] = (base, conf)
+                if isinstance(error, asyncio.CancelledError):
+                    raise
+                logger.error(f'{error.__class__.__name__}: {error}')
+                continue
+            n_rows = sum([len(rows) for rows in groups.values()])
+            if n_rows > 0:
+                logger.info(f'{len(dirty)}件の{self.cache[mode].name}データのうち{n_rows}件を書き込みました．')
+
+
+    async def create_record(self, obj:Union[discord.Member, discord.Guild]) -> Union[UserConf, GuildConf]:
+        """登録済みならその設定を読み，未登録なら初期設定で登録して返す．"""
         id = str(obj.id)
         name = obj.name
         if isinstance(obj, discord.Member):
@@ -162,12 +435,34 @@ class Postgres:
             conf = self.get_default('guild')
         
         async with self.pool.acquire() as con:
-            query = f'INSERT INTO {mode}s VALUES ({vind_str(self.n_param[mode] + 2)})'
-            await con.execute(query, id, name, *conf.values())
+            if (resp := await con.fetchrow(self.queries[mode]['upsert'], id, name, *conf)) is None:
+                resp = await con.fetchrow(self.queries[mode]['select'], id)
+                return CONF_TYPE[mode](*resp)
+            if not resp['created']:
+                return CONF_TYPE[mode](*tuple(resp)[1:])
+            if self.listen:
+                await con.execute('SELECT pg_notify($1, $2);', NOTIFY_CHANNEL, self.payload(mode, id, conf))
         logger.info(f'{display_mode}「{name}」のデータを新たに登録しました．')
         return conf
     
 
+    async def preload(self, mode:Literal['user', 'guild'], ids:List[int], chunk_size:int=1000) -> int:
+        """指定したidの設定をまとめて読み込んでキャッシュに載せる．DBにないidは初回のfetchで登録される．"""
+        ids = [str(id) for id in ids]
+        query = self.queries[mode]['preload']
+        n_loaded = 0
+        for i in range(0, len(ids), chunk_size):
+            async with self.pool.acquire() as con:
+                resp = await con.fetch(query, ids[i:i + chunk_size])
+            for row in resp:
+                #書き込み待ちの設定の方が新しい
+                if row['id'] not in self.dirty[mode]:
+                    self.cache[mode].put(row['id'], CONF_TYPE[mode](*tuple(row)[1:]))
+                    n_loaded += 1
+            logger.info(f'{self.cache[mode].name}データを読み込んでいます．({min(i + chunk_size, len(ids))}/{len(ids)})')
+        return n_loaded
+
+
     async def fetchall_targetch(self) -> dict:
         async with self.pool.acquire() as con:
             query = f'SELECT id, target_ch FROM guilds;'
@@ -179,5 +474,21 @@ class Postgres:
 
 
     async def disconnect(self) -> None:
+        if self.pool is None:
+            return
+        self.closing = True
+        if self.flusher is not None:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            self.flusher = None
+        #溜めている変更は必ず書き込んでから切断する
+        await self.flush()
+        if self.listener is not None:
+            await self.listener.close()
+            self.listener = None
         await self.pool.close()
+        self.pool = None
         logger.info('Postgresからの切断に成功しました．')
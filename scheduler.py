@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Union
+
+from tts import TTS
+from tts_service import RemoteTTS
+from utils import UserConf
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+class Overloaded(Exception):
+    """待ち行列が上限に達して合成を受け付けられなかったときに送出する．"""
+    pass
+
+
+class Job:
+    __slots__ = ('guild_id', 'text', 'voice_conf', 'future', 'start_tag', 'finish_tag', 'enqueued_at')
+
+    def __init__(self, guild_id:int, text:str, voice_conf:UserConf, future:asyncio.Future, start_tag:float, finish_tag:float) -> None:
+        self.guild_id = guild_id
+        self.text = text
+        self.voice_conf = voice_conf
+        self.future = future
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.enqueued_at = time.perf_counter()
+
+
+class SynthesisScheduler:
+    """全サーバーの合成ジョブをまとめて割り振るスケジューラ．
+
+    サーバーごとの待ち行列から公平キューイング(仮想終了時刻が最小のもの)で取り出してTTSへ渡す．
+    同時に合成する件数は全体とサーバーごとにそれぞれ上限を設け，全体の待ち件数が上限を超えたら受け付けない．
+    サーバーごとの待ち時間は，待ちも合成中もなくなったら捨てる(全体の集計だけ残す)．
+    """
+    def __init__(self, tts:Union[TTS, RemoteTTS], max_inflight:int=None, max_inflight_per_guild:int=2, max_queued:int=256) -> None:
+        self.tts = tts
+        #全体の同時合成数はワーカー数に合わせ，ワーカープール側では待たせない
+        self.max_inflight = max_inflight or tts.concurrency
+        self.max_inflight_per_guild = max_inflight_per_guild
+        self.max_queued = max_queued
+        self.queues: Dict[int, deque] = {}
+        self.inflight: Dict[int, int] = {}
+        self.last_finish: Dict[int, float] = {}
+        self.vtime = 0.0
+        self.n_queued = 0
+        self.n_inflight = 0
+        self.n_dropped = 0
+        self.waits: Dict[int, dict] = {}
+        self.total_wait = {'count': 0, 'total': 0.0, 'max': 0.0}
+
+
+    async def submit(self, guild_id:int, text:str, voice_conf:UserConf) -> Union[bytes, None]:
+        #キャッシュにあれば待ち行列に並ばない
+        if (pcm := await self.tts.lookup(text, *voice_conf)) is not None:
+            return pcm
+
+        if self.n_queued >= self.max_queued:
+            self.n_dropped += 1
+            logger.warning(f'合成の待ち行列が上限に達したため破棄しました．(guild: {guild_id}, {self.n_queued}/{self.max_queued})')
+            raise Overloaded
+
+        #合成にかかる時間は文字数におおよそ比例する
+        cost = max(len(text), 1)
+        start_tag = max(self.vtime, self.last_finish.get(guild_id, 0.0))
+        finish_tag = start_tag + cost
+        self.last_finish[guild_id] = finish_tag
+        job = Job(guild_id, text, voice_conf, asyncio.get_running_loop().create_future(), start_tag, finish_tag)
+        self.queues.setdefault(guild_id, deque()).append(job)
+        self.n_queued += 1
+        self.dispatch()
+        return await job.future
+
+
+    def pick(self) -> Union[Job, None]:
+        best = None
+        for guild_id, queue in self.queues.items():
+            if self.inflight.get(guild_id, 0) >= self.max_inflight_per_guild:
+                continue
+            if (best is None) or (queue[0].finish_tag < best.finish_tag):
+                best = queue[0]
+        return best
+
+
+    def dispatch(self) -> None:
+        while (self.n_inflight < self.max_inflight) and ((job := self.pick()) is not None):
+            queue = self.queues[job.guild_id]
+            queue.popleft()
+            if not queue:
+                del self.queues[job.guild_id]
+            self.n_queued -= 1
+            #待っている間に取り消されたジョブは合成しない
+            if job.future.cancelled():
+                self.forget(job.guild_id)
+                continue
+            self.vtime = max(self.vtime, job.start_tag)
+            self.inflight[job.guild_id] = self.inflight.get(job.guild_id, 0) + 1
+            self.n_inflight += 1
+            self.record_wait(job)
+            asyncio.create_task(self.run(job))
+
+
+    def record_wait(self, job:Job) -> None:
+        wait = time.perf_counter() - job.enqueued_at
+        for stat in [self.waits.setdefault(job.guild_id, {'count': 0, 'total': 0.0, 'max': 0.0}), self.total_wait]:
+            stat['count'] += 1
+            stat['total'] += wait
+            stat['max'] = max(stat['max'], wait)
+
+
+    async def run(self, job:Job) -> None:
+        try:
+            pcm = await self.tts.render(job.text, *job.voice_conf)
+            if not job.future.done():
+                job.future.set_result(pcm)
+        except Exception as error:
+            if not job.future.done():
+                job.future.set_exception(error)
+        finally:
+            self.inflight[job.guild_id] -= 1
+            self.n_inflight -= 1
+            if self.inflight[job.guild_id] == 0:
+                del self.inflight[job.guild_id]
+            self.forget(job.guild_id)
+            self.dispatch()
+
+
+    def forget(self, guild_id:int) -> None:
+        #待ちも合成中もなくなったサーバーは次から現在の仮想時刻で並び直す
+        if (guild_id not in self.queues) and (guild_id not in self.inflight):
+            self.last_finish.pop(guild_id, None)
+            self.waits.pop(guild_id, None)
+
+
+    def stats(self, top:int=None) -> dict:
+        """全体の集計と，待ち行列の深い順にtop件(Noneなら全部)のサーバーの値．"""
+        guilds = sorted(set(self.queues) | set(self.inflight), key=lambda guild_id: (len(self.queues.get(guild_id, ())), self.inflight.get(guild_id, 0)), reverse=True)
+        return {
+            'queued': self.n_queued,
+            'inflight': self.n_inflight,
+            'dropped': self.n_dropped,
+            'avg_wait': average(self.total_wait),
+            'max_wait': self.total_wait['max'],
+            'guilds': {guild_id: {
+                'queued': len(self.queues.get(guild_id, ())),
+                'inflight': self.inflight.get(guild_id, 0),
+                'avg_wait': average(self.waits.get(guild_id)),
+                'max_wait': self.waits[guild_id]['max'] if guild_id in self.waits else 0.0
+            } for guild_id in guilds[:top]}
+        }
+
+
+def average(stat:Union[dict, None]) -> float:
+    return stat['total'] / stat['count'] if stat and stat['count'] else 0.0
@@ -1,10 +1,16 @@
+import asyncio
+import math
 import subprocess
 import os
-import string
-import random
-from typing import Union
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Tuple, Union
 
 from utils import random_voice
+from audio import decode_wav, encode_opus
+import dsp
+from audio_cache import AudioCache
+from metrics import metrics
 
 from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
 
@@ -19,21 +25,28 @@ hdlr.setFormatter(fmt)
 logger.addHandler(hdlr)
 
 
-def random_name(n:int) -> str:
-        return ''.join(random.choices(string.ascii_letters + string.digits, k=n))
-
-
 class TTS:
-    def __init__(self, openjtalk_dir:str='./openjtalk', outdir:str='./wav/tmp') -> None:
+    def __init__(self, openjtalk_dir:str='./openjtalk', max_concurrency:int=None, n_spares:int=None, cache:AudioCache=None, opus:bool=False, postprocess:bool=False) -> None:
         self.openjtalk = f'{openjtalk_dir}/open_jtalk'
         self.dic = f'{openjtalk_dir}/dic'
         self.htsvoice = f'{openjtalk_dir}/htsvoice'
-        self.outdir = outdir
-        os.makedirs(self.outdir, exist_ok=True)
+        #同時に合成するワーカー数（未指定ならCPU数）
+        self.pool = SynthesisPool(self, max_concurrency, n_spares)
+        self.cache = cache
+        #合成したらすぐOpusに符号化し，キャッシュにも符号化済みのものを入れる
+        self.opus = opus
+        #スピードとエフェクトをopen_jtalkに渡さず，基準の音声に後処理(dsp.py)で付ける
+        if postprocess and not dsp.available():
+            logger.warning('NumPyがないため後処理を使わずに合成します．')
+        self.postprocess = postprocess and dsp.available()
+
+
+    @property
+    def concurrency(self) -> int:
+        return self.pool.n_workers
 
 
-    def synthesize(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[str, None]:
-        wavpath = f'{self.outdir}/{random_name(8)}.wav'
+    def command(self, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> List[str]:
         tone = str(1.5 * int(tone))
         #感情がsadなら基準のspeedを少し速くする
         if emotion == 'sad':
@@ -44,7 +57,8 @@ class TTS:
         open_jtalk = [self.openjtalk]
         dic = ['-x', self.dic]
         htsvoice = ['-m', f'{self.htsvoice}/{speaker}/{emotion}.htsvoice']
-        outwav = ['-ow', wavpath]
+        #ファイルを介さずパイプで受け取る
+        outwav = ['-ow', '/dev/stdout']
         _tone = ['-fm', tone]
         _speed = ['-r', speed]
         volume = ['-g', '10']
@@ -53,26 +67,311 @@ class TTS:
             cmd.extend(['-a', '0.4'])
         elif effect == 'whisper':
             cmd.extend(['-u', '1.0'])
+        return cmd
+
+
+    def handle_error(self, err_lines:str) -> None:
+        #読み上げられる文字がない以外のエラーならログ表示
+        if 'No phenome.' in err_lines:
+            metrics.inc('synthesis_failures_total', reason='no_phenome')
+        else:
+            metrics.inc('synthesis_failures_total', reason='error')
+            for line in err_lines.split('\n'):
+                level, message = tuple(line.split(': ', maxsplit=1))
+                if level == 'Warning':
+                    logger.warning(message)
+                elif level == 'Error':
+                    logger.error(message)
+
+
+    def synthesize(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        cmd = self.command(speaker, emotion, effect, tone, speed)
         
-        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-        proc.stdin.write(text.encode())
-        proc.stdin.close()
-        proc.wait()
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate(text.encode())
+        metrics.inc('openjtalk_exit_total', code=proc.returncode)
+        if proc.returncode != 0:
+            self.handle_error(stderr.decode().strip())
+            return None
+
+        return decode_wav(stdout)
+
+
+    async def synthesize_async(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        #キャッシュにあればopen_jtalkを使わない
+        if (pcm := await self.lookup(text, speaker, emotion, effect, tone, speed)) is not None:
+            return pcm
+        return await self.render(text, speaker, emotion, effect, tone, speed)
+
+
+    async def lookup(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        if self.cache is None:
+            return None
+        pcm = await self.cache.load(self.cache.key(text, speaker, emotion, effect, tone, speed))
+        metrics.inc('audio_cache_total', result='miss' if pcm is None else 'hit')
+        return pcm
+
+
+    async def render(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        #イベントループを止めないようにワーカープールで合成する
+        with metrics.timer('synthesis_seconds', backend='local'):
+            if self.postprocess:
+                pcm = await self.render_variant(text, speaker, emotion, effect, tone, speed)
+            else:
+                pcm = await self.pool.submit(text, (speaker, emotion, effect, tone, speed))
+        if self.opus and (pcm is not None):
+            with metrics.timer('opus_encode_seconds'):
+                pcm = await asyncio.get_running_loop().run_in_executor(None, encode_opus, pcm)
+        if (self.cache is not None) and (pcm is not None):
+            self.cache.put(self.cache.key(text, speaker, emotion, effect, tone, speed), pcm)
+        return pcm
+
+
+    async def render_variant(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        #話者・感情・トーンが同じなら基準の音声を使い回す
+        base = dsp.base_voice(speaker, emotion, effect, tone, speed)
+        pcm = None
+        if self.cache is not None:
+            pcm = await self.cache.load(self.cache.base_key(text, speaker, emotion, tone))
+            metrics.inc('audio_cache_total', result='base_miss' if pcm is None else 'base_hit')
+        if pcm is None:
+            if (pcm := await self.pool.submit(text, base)) is None:
+                return None
+            if self.cache is not None:
+                self.cache.put(self.cache.base_key(text, speaker, emotion, tone), pcm)
+        if base == (speaker, emotion, effect, tone, speed):
+            return pcm
+        with metrics.timer('dsp_seconds', effect=effect):
+            return await asyncio.get_running_loop().run_in_executor(None, dsp.process, pcm, speed, effect)
+
+
+    def stats(self) -> dict:
+        return {'pool': self.pool.stats()}
+
+
+    async def close(self) -> None:
+        await self.pool.close()
+        if self.cache is not None:
+            await self.cache.close()
+
+
+class SynthesisPool:
+    """open_jtalkの合成ジョブを処理する常駐ワーカー群．
+
+    open_jtalkは1回の合成ごとに終了するため，辞書と音響モデルを読み込ませた
+    予備プロセスをコマンドライン引数ごとに起動しておき，次のジョブではそれに標準入力を渡すだけにする．
+    ボイス設定はすべて引数で渡すしかないので，ユーザーごとにボイスが違うと予備はほとんど使われない．
+    使われずに捨てられる予備を減らすため，予備を用意するのは直近history件のジョブでの使用回数が多い順にn_spares個までの引数で，
+    そのうちmin_share以上の割合を占めるものだけにする．
+    """
+    def __init__(self, tts:TTS, n_workers:int=None, n_spares:int=None, history:int=64, min_share:float=1 / 16) -> None:
+        self.tts = tts
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.n_spares = self.n_workers if n_spares is None else n_spares
+        self.queue = None
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.spares = OrderedDict()
+        #直近history件のジョブの引数と，引数ごとの使用回数
+        self.recent = deque(maxlen=history)
+        self.uses: Dict[Tuple[str, ...], int] = {}
+        self.min_uses = max(math.ceil(history * min_share), 2)
+        self.replenishing: Dict[Tuple[str, ...], asyncio.Task] = {}
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_wasted = 0
+        self.n_spawned = 0
+        self.n_restarts = 0
+        self.closed = False
+
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        for i in range(self.n_workers):
+            self.start_worker(i)
+        logger.info(f'合成ワーカーを{self.n_workers}個起動しました．')
+
+
+    def start_worker(self, i:int) -> None:
+        task = asyncio.create_task(self.worker())
+        task.add_done_callback(lambda task: self.on_worker_done(i, task))
+        self.workers[i] = task
+
+
+    def on_worker_done(self, i:int, task:asyncio.Task) -> None:
+        if self.closed:
+            return
+        #想定外に終了したワーカーは再起動する
+        if task.cancelled():
+            logger.error(f'合成ワーカー{i}が取り消されたため再起動します．')
+        elif (error := task.exception()) is not None:
+            logger.error(f'合成ワーカー{i}が終了したため再起動します．({error.__class__.__name__}: {error})')
+        else:
+            logger.error(f'合成ワーカー{i}が終了したため再起動します．')
+        self.n_restarts += 1
+        self.start_worker(i)
+
+
+    def qsize(self) -> int:
+        return 0 if self.queue is None else self.queue.qsize()
+
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.n_workers,
+            'queue': self.qsize(),
+            'spares': sum(len(procs) for procs in self.spares.values()),
+            'spare_hits': self.n_hits,
+            'spare_misses': self.n_misses,
+            'spare_wasted': self.n_wasted,
+            'spawned': self.n_spawned,
+            'restarts': self.n_restarts
+        }
+
+
+    async def submit(self, text:str, key:Tuple[str, ...]) -> Union[bytes, None]:
+        if self.queue is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, key, future))
+        return await future
+
+
+    async def worker(self) -> None:
+        while True:
+            text, key, future = await self.queue.get()
+            try:
+                if not future.cancelled():
+                    args = tuple(self.tts.command(*key))
+                    pcm = await self.run(text, args)
+                    if not future.cancelled():
+                        future.set_result(pcm)
+                    #同じ引数の次のジョブに備える(起動はワーカーの外で行う)
+                    self.schedule_replenish(args)
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            finally:
+                self.queue.task_done()
+
+
+    async def spawn(self, args:Tuple[str, ...]) -> asyncio.subprocess.Process:
+        self.n_spawned += 1
+        return await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+
+    def use(self, args:Tuple[str, ...]) -> None:
+        if len(self.recent) == self.recent.maxlen:
+            old_args = self.recent[0]
+            if (count := self.uses[old_args] - 1) == 0:
+                del self.uses[old_args]
+            else:
+                self.uses[old_args] = count
+        self.recent.append(args)
+        self.uses[args] = self.uses.get(args, 0) + 1
+
+
+    def record(self, result:str) -> None:
+        if result == 'hit':
+            self.n_hits += 1
+        elif result == 'miss':
+            self.n_misses += 1
+        else:
+            self.n_wasted += 1
+        metrics.inc('openjtalk_spare_total', result=result)
+
+
+    async def acquire(self, args:Tuple[str, ...]) -> asyncio.subprocess.Process:
+        self.use(args)
+        while (procs := self.spares.get(args)):
+            proc = procs.popleft()
+            if not procs:
+                del self.spares[args]
+            if proc.returncode is None:
+                self.record('hit')
+                return proc
+            #待機中に落ちていたプロセスは捨てて起動し直す
+            logger.warning(f'待機中のopen_jtalkが終了していました．(returncode: {proc.returncode})')
+            self.n_restarts += 1
+        self.record('miss')
+        return await self.spawn(args)
+
+
+    def wants_spare(self, args:Tuple[str, ...]) -> bool:
+        #直近での使用回数がmin_uses回以上で，多い順にn_spares番目までに入る引数だけ
+        if (uses := self.uses.get(args, 0)) < self.min_uses:
+            return False
+        ranked = sorted(self.uses.values(), reverse=True)
+        if uses < ranked[min(self.n_spares, len(ranked)) - 1]:
+            return False
+        #予備が上限まであるときは，それより使われていない引数の予備がなければ起動しない(すぐ捨てることになる)
+        if sum(len(procs) for procs in self.spares.values()) >= self.n_spares:
+            return any(self.uses.get(old_args, 0) < uses for old_args in self.spares)
+        return True
+
+
+    def schedule_replenish(self, args:Tuple[str, ...]) -> None:
+        if self.closed or (self.n_spares == 0) or (args in self.replenishing) or (not self.wants_spare(args)):
+            return
+        task = self.replenishing[args] = asyncio.create_task(self.replenish(args))
+        task.add_done_callback(lambda _: self.replenishing.pop(args, None))
+
+
+    async def replenish(self, args:Tuple[str, ...]) -> None:
+        try:
+            proc = await self.spawn(args)
+        except OSError as error:
+            logger.error(f'{error.__class__.__name__}: {error}')
+            return
+        if self.closed:
+            self.discard(proc)
+            return
+        self.spares.setdefault(args, deque()).append(proc)
+        self.spares.move_to_end(args)
+        #上限を超えたら直近で最も使われていない引数の予備から捨てる(同じなら古い方から)
+        while sum(len(procs) for procs in self.spares.values()) > self.n_spares:
+            old_args = min(self.spares, key=lambda old_args: self.uses.get(old_args, 0))
+            procs = self.spares[old_args]
+            self.discard(procs.popleft())
+            self.record('wasted')
+            if not procs:
+                del self.spares[old_args]
+
+
+    def discard(self, proc:asyncio.subprocess.Process) -> None:
+        if proc.returncode is None:
+            proc.kill()
+
+
+    async def run(self, text:str, args:Tuple[str, ...]) -> Union[bytes, None]:
+        proc = await self.acquire(args)
+        start = time.perf_counter()
+        try:
+            stdout, stderr = await proc.communicate(text.encode())
+        except (BrokenPipeError, ConnectionResetError):
+            #標準入力を渡す直前に落ちた場合は新しいプロセスでやり直す
+            self.n_restarts += 1
+            self.discard(proc)
+            proc = await self.spawn(args)
+            stdout, stderr = await proc.communicate(text.encode())
+        metrics.observe('openjtalk_seconds', time.perf_counter() - start)
+        metrics.inc('openjtalk_exit_total', code=proc.returncode)
         if proc.returncode != 0:
-            #読み上げられる文字がない以外のエラーならログ表示
-            if 'No phenome.' not in (err_lines := proc.stderr.read().decode().strip()):
-                for line in err_lines.split('\n'):
-                    level, message = tuple(line.split(': ', maxsplit=1))
-                    if level == 'Warning':
-                        logger.warning(message)
-                    elif level == 'Error':
-                        logger.error(message)
-            #ファイルが作成されていれば削除したうえでNoneを返す
-            if os.path.exists(wavpath):
-                os.remove(wavpath)
-            wavpath = None
-
-        return wavpath
+            self.tts.handle_error(stderr.decode().strip())
+            return None
+        return decode_wav(stdout)
+
+
+    async def close(self) -> None:
+        self.closed = True
+        for task in [*self.workers.values(), *self.replenishing.values()]:
+            task.cancel()
+        await asyncio.gather(*self.workers.values(), *self.replenishing.values(), return_exceptions=True)
+        spares = [proc for procs in self.spares.values() for proc in procs]
+        self.spares.clear()
+        for proc in spares:
+            self.discard(proc)
+        await asyncio.gather(*[proc.wait() for proc in spares])
+        logger.info('合成ワーカーを停止しました．')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import os
+import struct
+import time
+from typing import List, Tuple, Union
+
+from dotenv import load_dotenv
+
+from tts import TTS
+from audio import opus_available
+from audio_cache import AudioCache
+from metrics import metrics
+
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
+
+
+logger = getLogger(__name__)
+logger.setLevel(DEBUG)
+logger.propagate = False
+hdlr = StreamHandler()
+hdlr.setLevel(DEBUG)
+fmt = Formatter(fmt='[{asctime}][{name}][{funcName}][{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S' ,style='{')
+hdlr.setFormatter(fmt)
+logger.addHandler(hdlr)
+
+
+#1つのメッセージは (ヘッダーの長さ, 音声の長さ) + JSONのヘッダー + 音声
+FRAME = struct.Struct('>II')
+MAX_HEADER = 2**20
+MAX_PAYLOAD = 256 * 2**20
+
+
+async def read_frame(reader:asyncio.StreamReader) -> Tuple[dict, bytes]:
+    header_len, payload_len = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if (header_len > MAX_HEADER) or (payload_len > MAX_PAYLOAD):
+        raise ValueError(f'メッセージが大きすぎます．(header: {header_len}, payload: {payload_len})')
+    header = json.loads(await reader.readexactly(header_len))
+    payload = await reader.readexactly(payload_len) if payload_len else b''
+    return header, payload
+
+
+def write_frame(writer:asyncio.StreamWriter, header:dict, payload:bytes=b'') -> None:
+    data = json.dumps(header, ensure_ascii=False).encode()
+    writer.write(FRAME.pack(len(data), len(payload)) + data)
+    if payload:
+        writer.write(payload)
+
+
+async def open_connection(address:str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    #unix:/path/to/sock または host:port
+    if address.startswith('unix:'):
+        return await asyncio.open_unix_connection(address[len('unix:'):])
+    host, port = address.rsplit(':', maxsplit=1)
+    return await asyncio.open_connection(host, int(port))
+
+
+class TTSService:
+    """open_jtalkでの合成をbotとは別のプロセスで受け持つサーバー．
+
+    まとめて送られてきた合成要求(text, ボイス設定)をワーカープールで並行して合成し，音声をまとめて返す．
+    statsでワーカーの負荷を返すので，複数のbotプロセスで1つのサーバーを共有できる．
+    """
+    def __init__(self, tts:TTS) -> None:
+        self.tts = tts
+        self.n_connections = 0
+        self.n_requests = 0
+        self.n_items = 0
+        self.n_inflight = 0
+        self.started_at = time.monotonic()
+
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        self.n_connections += 1
+        try:
+            while True:
+                try:
+                    header, _ = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if header.get('op') == 'synthesize':
+                    lengths, payload = await self.synthesize(header['items'])
+                    write_frame(writer, {'id': header.get('id'), 'lengths': lengths}, payload)
+                elif header.get('op') == 'stats':
+                    write_frame(writer, {'id': header.get('id'), 'stats': self.stats()})
+                else:
+                    write_frame(writer, {'id': header.get('id'), 'error': f'unknown op: {header.get("op")}'})
+                await writer.drain()
+        except Exception as error:
+            logger.error(f'{error.__class__.__name__}: {error}')
+        finally:
+            self.n_connections -= 1
+            writer.close()
+
+
+    async def synthesize(self, items:List[list]) -> Tuple[List[Union[int, None]], bytes]:
+        self.n_requests += 1
+        self.n_items += len(items)
+        #同じ要求が複数あれば1回だけ合成する
+        unique = {}
+        for text, voice_conf in items:
+            unique.setdefault((text, *voice_conf), None)
+        keys = list(unique)
+        self.n_inflight += len(keys)
+        try:
+            results = await asyncio.gather(*[self.tts.synthesize_async(*key) for key in keys], return_exceptions=True)
+        finally:
+            self.n_inflight -= len(keys)
+        for key, pcm in zip(keys, results):
+            if isinstance(pcm, Exception):
+                logger.error(f'{pcm.__class__.__name__}: {pcm}')
+                pcm = None
+            unique[key] = pcm
+        lengths = []
+        chunks = []
+        for text, voice_conf in items:
+            pcm = unique[(text, *voice_conf)]
+            lengths.append(None if pcm is None else len(pcm))
+            if pcm is not None:
+                chunks.append(pcm)
+        return lengths, b''.join(chunks)
+
+
+    def stats(self) -> dict:
+        return {
+            'uptime': time.monotonic() - self.started_at,
+            'connections': self.n_connections,
+            'requests': self.n_requests,
+            'items': self.n_items,
+            'inflight': self.n_inflight,
+            'pool': self.tts.pool.stats(),
+            'cache': None if self.tts.cache is None else self.tts.cache.stats()
+        }
+
+
+    async def serve(self, address:str) -> None:
+        if address.startswith('unix:'):
+            server = await asyncio.start_unix_server(self.handle, address[len('unix:'):])
+        else:
+            host, port = address.rsplit(':', maxsplit=1)
+            server = await asyncio.start_server(self.handle, host, int(port))
+        logger.info(f'合成サーバーを{address}で起動しました．')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.tts.close()
+
+
+class RemoteTTS:
+    """合成サーバーを使うTTS．TTSと同じくlookupとrenderを持つのでSynthesisSchedulerにそのまま渡せる．
+
+    同時に呼ばれたrenderはbatch_delay秒までまとめて1回で送る．接続はmax_connections本まで使い回す．
+    サーバーに繋がらないときやtimeoutを過ぎたときはfallbackのTTSで合成し，retry_after秒はサーバーを使わない．
+    """
+    def __init__(self, address:str, concurrency:int=8, max_connections:int=4, timeout:float=10.0, batch_size:int=16, batch_delay:float=0.005, retry_after:float=5.0, cache:AudioCache=None, fallback:TTS=None) -> None:
+        self.address = address
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.retry_after = retry_after
+        self.cache = cache
+        self.fallback = fallback
+        self.connections = asyncio.Semaphore(max_connections)
+        self.idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self.batch: List[Tuple[str, Tuple[str, ...], asyncio.Future]] = []
+        self.batch_timer = None
+        self.down_until = 0.0
+        self.n_batches = 0
+        self.n_items = 0
+        self.n_fallbacks = 0
+
+
+    async def lookup(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        if self.cache is None:
+            return None
+        pcm = await self.cache.load(self.cache.key(text, speaker, emotion, effect, tone, speed))
+        metrics.inc('audio_cache_total', result='miss' if pcm is None else 'hit')
+        return pcm
+
+
+    async def synthesize_async(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        if (pcm := await self.lookup(text, speaker, emotion, effect, tone, speed)) is not None:
+            return pcm
+        return await self.render(text, speaker, emotion, effect, tone, speed)
+
+
+    async def render(self, text:str, speaker:str='mei', emotion:str='normal', effect:str='none', tone:str='0', speed:str='0') -> Union[bytes, None]:
+        voice_conf = (speaker, emotion, effect, tone, speed)
+        with metrics.timer('synthesis_seconds', backend='remote'):
+            if time.monotonic() < self.down_until:
+                pcm = await self.render_locally(text, voice_conf)
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self.batch.append((text, voice_conf, future))
+                if len(self.batch) >= self.batch_size:
+                    self.send_batch()
+                elif self.batch_timer is None:
+                    self.batch_timer = asyncio.get_running_loop().call_later(self.batch_delay, self.send_batch)
+                pcm = await future
+        if (self.cache is not None) and (pcm is not None):
+            self.cache.put(self.cache.key(text, *voice_conf), pcm)
+        return pcm
+
+
+    def send_batch(self) -> None:
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        batch, self.batch = self.batch, []
+        if batch:
+            asyncio.create_task(self.request(batch))
+
+
+    async def request(self, batch:List[Tuple[str, Tuple[str, ...], asyncio.Future]]) -> None:
+        try:
+            header, payload = await asyncio.wait_for(self.call({'op': 'synthesize', 'items': [[text, voice_conf] for text, voice_conf, _ in batch]}), self.timeout)
+            self.n_batches += 1
+            self.n_items += len(batch)
+            pos = 0
+            for (_, _, future), length in zip(batch, header['lengths']):
+                pcm = None
+                if length is not None:
+                    pcm = payload[pos:pos + length]
+                    pos += length
+                if not future.done():
+                    future.set_result(pcm)
+        except Exception as error:
+            self.down_until = time.monotonic() + self.retry_after
+            logger.warning(f'合成サーバーを使えないため，{self.retry_after}秒間はこのプロセスで合成します．({error.__class__.__name__}: {error})')
+            results = await asyncio.gather(*[self.render_locally(text, voice_conf) for text, voice_conf, _ in batch], return_exceptions=True)
+            for (_, _, future), pcm in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(pcm, Exception):
+                    future.set_exception(pcm)
+                else:
+                    future.set_result(pcm)
+
+
+    async def render_locally(self, text:str, voice_conf:Tuple[str, ...]) -> Union[bytes, None]:
+        if self.fallback is None:
+            metrics.inc('synthesis_failures_total', reason='service_unavailable')
+            return None
+        self.n_fallbacks += 1
+        return await self.fallback.render(text, *voice_conf)
+
+
+    async def call(self, header:dict, payload:bytes=b'') -> Tuple[dict, bytes]:
+        async with self.connections:
+            while self.idle:
+                reader, writer = self.idle.pop()
+                if not writer.is_closing():
+                    break
+            else:
+                reader, writer = await open_connection(self.address)
+            try:
+                write_frame(writer, header, payload)
+                await writer.drain()
+                resp = await read_frame(reader)
+            except BaseException:
+                #途中で失敗した接続は応答がずれるので使い回さない
+                writer.close()
+                raise
+            self.idle.append((reader, writer))
+            return resp
+
+
+    async def remote_stats(self) -> dict:
+        header, _ = await asyncio.wait_for(self.call({'op': 'stats'}), self.timeout)
+        return header['stats']
+
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.n_batches,
+            'items': self.n_items,
+            'fallbacks': self.n_fallbacks,
+            'idle_connections': len(self.idle),
+            'down': time.monotonic() < self.down_until,
+            'fallback': None if self.fallback is None else self.fallback.stats()
+        }
+
+
+    async def close(self) -> None:
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+        if self.cache is not None:
+            await self.cache.close()
+        if self.fallback is not None:
+            await self.fallback.close()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    #unix:/path/to/sock または host:port
+    TTS_SERVICE_ADDR = os.environ.get('TTS_SERVICE_ADDR') or '127.0.0.1:50051'
+    TTS_CONCURRENCY = int(os.environ.get('TTS_CONCURRENCY') or 0) or None
+    AUDIO_CACHE_MB = int(os.environ.get('AUDIO_CACHE_MB') or 64)
+    AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR') or None
+    AUDIO_CACHE_DISK_MB = int(os.environ.get('AUDIO_CACHE_DISK_MB') or 512)
+    audio_cache = AudioCache(AUDIO_CACHE_MB * 2**20, AUDIO_CACHE_DIR, AUDIO_CACHE_DISK_MB * 2**20)
+    OPUS_PREENCODE = os.environ.get('OPUS_PREENCODE', 'true').lower() in {'1', 'true', 'yes'} and opus_available()
+    TTS_DSP = os.environ.get('TTS_DSP', '').lower() in {'1', 'true', 'yes'}
+    service = TTSService(TTS(max_concurrency=TTS_CONCURRENCY, cache=audio_cache, opus=OPUS_PREENCODE, postprocess=TTS_DSP))
+    asyncio.run(service.serve(TTS_SERVICE_ADDR))
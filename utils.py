@@ -1,4 +1,5 @@
-from copy import deepcopy
+from collections import OrderedDict
+from functools import cached_property
 import discord
 from discord.ext import commands
 import re
@@ -6,17 +7,38 @@ import random
 import demoji
 import unicodedata
 import jaconv
-from typing import Literal, Union
+import sys
+import time
+from typing import Hashable, List, Literal, NamedTuple, Union
 
 
-def random_voice() -> dict:
-    voice_conf = {}
-    voice_conf['speaker'] = random.choice(['mei', 'takumi'])
-    voice_conf['emotion'] = random.choice(['normal', 'happy', 'angry', 'sad'])
-    voice_conf['effect'] = random.choice(['none', 'none', 'robot', 'whisper'])
-    voice_conf['tone'] = random.choice(['-5', '-4', '-3', '-2', '-1', '0', '+1', '+2', '+3', '+4', '+5'])
-    voice_conf['speed'] = '0'
-    return voice_conf
+#設定は変更不可の値として扱い，変えるときは_replaceで新しく作る
+class UserConf(NamedTuple):
+    speaker:str = 'mei'
+    emotion:str = 'normal'
+    effect:str = 'none'
+    tone:str = '0'
+    speed:str = '0'
+
+
+class GuildConf(NamedTuple):
+    prefix:str = ';'
+    target_ch:str = 'all'
+    auto_join:bool = True
+    read_access:bool = True
+    read_author:bool = False
+    read_outsider:bool = False
+    max_chars:int = 200
+
+
+def random_voice() -> UserConf:
+    return UserConf(
+        speaker=random.choice(['mei', 'takumi']),
+        emotion=random.choice(['normal', 'happy', 'angry', 'sad']),
+        effect=random.choice(['none', 'none', 'robot', 'whisper']),
+        tone=random.choice(['-5', '-4', '-3', '-2', '-1', '0', '+1', '+2', '+3', '+4', '+5']),
+        speed='0'
+    )
 
 
 def normalized_str(s:str) -> str:
@@ -31,7 +53,7 @@ def signed_int_str(s:str) -> str:
     return str(s) if s <= 0 else '+' + str(s)
 
 
-def my_normalizer(text:str) -> str:
+def reference_normalizer(text:str) -> str:
     text = unicodedata.normalize('NFKC', text)
     text = text.upper()
     text = jaconv.normalize(text, 'NFKC')
@@ -40,45 +62,238 @@ def my_normalizer(text:str) -> str:
     return text
 
 
+def composing_chars() -> frozenset:
+    #直前の文字と合成・並べ替えされうる文字（結合文字と正準分解の2文字目，ハングルの中声・終声）
+    chars = {chr(cp) for cp in range(0x1161, 0x1176)} | {chr(cp) for cp in range(0x11A8, 0x11C3)}
+    for cp in range(sys.maxunicode + 1):
+        c = chr(cp)
+        if unicodedata.combining(c):
+            chars.add(c)
+        elif (d := unicodedata.decomposition(c)) and (d[0] != '<') and len(parts := d.split()) == 2:
+            chars.add(chr(int(parts[1], 16)))
+    return frozenset(chars)
+
+
+class NormalizeTable(dict):
+    """reference_normalizerを1文字ずつ適用した結果を必要になったときに埋めていくstr.translate用の表．
+
+    前後の文字と合成されうる文字はunsafeに記録し，それを含む文字列は文字単位で変換しない．
+    合成されうる文字の一覧は全コードポイントを調べるので，importのたびではなく最初に使うときに作る．
+    """
+    @cached_property
+    def composing(self) -> frozenset:
+        return composing_chars()
+
+    @cached_property
+    def unsafe(self) -> set:
+        return set(self.composing)
+
+    def __missing__(self, cp:int) -> str:
+        c = chr(cp)
+        self[cp] = out = reference_normalizer(c)
+        if not self.composing.isdisjoint(out):
+            self.unsafe.add(c)
+        return out
+
+
+normalize_table = NormalizeTable()
+
+def my_normalizer(text:str) -> str:
+    #ほとんどの文字列は表引き1回で済む
+    out = text.translate(normalize_table)
+    unsafe = normalize_table.unsafe
+    if unsafe.isdisjoint(text):
+        return out
+    #合成されうる文字は直前の文字とひとまとまりにして元の手順で変換する
+    pieces = []
+    i, n = 0, len(text)
+    while i < n:
+        j = i + 1
+        while (j < n) and (text[j] in unsafe):
+            j += 1
+        if (j == i + 1) and (text[i] not in unsafe):
+            pieces.append(normalize_table[ord(text[i])])
+        else:
+            pieces.append(reference_normalizer(text[i:j]))
+        i = j
+    return ''.join(pieces)
+
+
+def char_class(cps:List[int]) -> str:
+    #連続するコードポイントを範囲にまとめて正規表現の文字クラスにする
+    ranges = []
+    for cp in sorted(cps):
+        if ranges and (ranges[-1][1] == cp - 1):
+            ranges[-1][1] = cp
+        else:
+            ranges.append([cp, cp])
+    return '[' + ''.join(f'\\U{lo:08x}' if lo == hi else f'\\U{lo:08x}-\\U{hi:08x}' for lo, hi in ranges) + ']'
+
+
+def emoji_pattern() -> str:
+    """demojiが持つ絵文字の列のどれか1つに一致する正規表現．demoji.replaceと同じく，各位置で最も長いものに一致する．
+
+    絵文字の列を先頭の文字からの木にして，続きがあれば先にそちらを試す．続きのない文字は文字クラスにまとめる．
+    ZWJやFE0F，国旗の片割れなどの部品は，それだけでは絵文字ではないので列の中でしか一致しない．
+    """
+    demoji.set_emoji_pattern()
+    trie = {}
+    for code in demoji._CODE_TO_DESC:
+        node = trie
+        for c in code:
+            node = node.setdefault(c, {})
+        node[''] = {}
+    def follow(node:dict) -> str:
+        #nodeまで一致したあとの続き．続きのない文字はまとめて文字クラスにする
+        leaves = [ord(c) for c, child in node.items() if c and (list(child) == [''])]
+        branches = [re.escape(c) + follow(child) for c, child in node.items() if c and (list(child) != [''])]
+        #先頭の文字はどれも違うので試す順番で結果は変わらない．多い方の続きのない文字から試す
+        if leaves:
+            branches.insert(0, char_class(leaves))
+        if not branches:
+            return ''
+        return '(?:' + '|'.join(branches) + ')' + ('?' if '' in node else '')
+    #絵文字の先頭になる文字でなければ木は試さない．BMPだけの文字クラスは表引き1回で済むので，
+    #BMP外の文字は1つの範囲で大まかに見て，細かい判定は木に任せる
+    bmp = [ord(c) for c in trie if ord(c) <= 0xFFFF]
+    astral = [ord(c) for c in trie if ord(c) > 0xFFFF]
+    return f'(?={char_class(bmp)}|[\\U{min(astral):08x}-\\U{max(astral):08x}]){follow(trie)}'
+
+
 #正規表現を先にコンパイルしておく
-user_mention_pattern = re.compile(r'<@!?(\d+)>')
-role_mention_pattern = re.compile(r'<@&(\d+)>')
-channel_mention_pattern = re.compile(r'<#(\d+)>')
+mention_pattern = re.compile(r'<(@[!&]?|#)(\d+)>')
 special_pattern = re.compile(r'<.*>')
-url_pattern = re.compile(r'https?://[\w/:%#\$&\?\(\)~\.=\+\-]+')
-www_pattern = re.compile(r'(w+|W+|ｗ+|Ｗ+|笑+|\(笑\)|（笑）)$')
+emoji_char = emoji_pattern()
+#URLと絵文字を1回の走査で見分ける．間の絵文字は削除されるので，URLはそれをまたいで続く(数字で始まるキーキャップも先に絵文字として試す)
+#　絵文字の連続を量指定子の中でさらに繰り返すと，一致しないときのバックトラックが絵文字の数について指数的になるので1つずつにする
+token_pattern = re.compile(
+    f'(?P<url>https?://(?:{emoji_char}|[\\w/:%#\\$&\\?\\(\\)~\\.=\\+\\-])+)'
+    f'|(?P<emoji>(?:{emoji_char})+)'
+)
+token_repl = {'emoji': '', 'url': '，URL，'}
+laugh_chars = {'w', 'W', 'ｗ', 'Ｗ', '笑'}
+
 
-async def modify_text(message:discord.Message, guild_conf:dict, bot:commands.Bot) -> str:
+def replace_laugh(text:str) -> str:
+    #末尾の笑いは正規表現を使わず後ろから数える（間の絵文字などは先に削除済み）
+    if text.endswith(('(笑)', '（笑）')):
+        return text[:-3] + '，藁．'
+    if text[-1:] in laugh_chars:
+        return text.rstrip(text[-1]) + '，藁．'
+    return text
+
+
+def replace_tokens(text:str) -> str:
+    #特殊パターンを先に消す(消したあとにつながった絵文字やURLもそのまま見分けられる)
+    text = special_pattern.sub('', text)
+    return replace_laugh(token_pattern.sub(lambda match: token_repl[match.lastgroup], text))
+
+
+class TTLCache:
+    """一定時間だけ値を保持するキャッシュ．上限を超えたら古いものから捨てる．"""
+    def __init__(self, ttl:float, size:int) -> None:
+        self.body = OrderedDict()
+        self.ttl = ttl
+        self.size = size
+
+    def get(self, key:Hashable) -> Union[str, None]:
+        if (item := self.body.get(key)) is None:
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self.body[key]
+            return None
+        return value
+
+    def put(self, key:Hashable, value:str) -> None:
+        self.body.pop(key, None)
+        self.body[key] = (value, time.monotonic() + self.ttl)
+        if len(self.body) > self.size:
+            self.body.popitem(last=False)
+
+
+#APIから取得した名前は10分間使い回す（取得に失敗した場合は空文字列）
+mention_cache = TTLCache(600, 1000)
+
+async def mention_name(kind:str, id:int, message:discord.Message, bot:commands.Bot) -> str:
+    #メッセージに含まれる情報→ゲートウェイのキャッシュ→TTLキャッシュ→APIの順で探す
+    if kind == '@&':
+        role = message.guild.get_role(id)
+        return '' if role is None else role.name
+    elif kind == '#':
+        channel = message.guild.get_channel(id) or bot.get_channel(id)
+        if channel is not None:
+            return channel.name
+    else:
+        for user in message.mentions:
+            if user.id == id:
+                return user.display_name
+        if (member := message.guild.get_member(id)) is not None:
+            return member.display_name
+
+    if (name := mention_cache.get((kind, id))) is not None:
+        return name
+    try:
+        if kind == '#':
+            name = (await bot.fetch_channel(id)).name
+        else:
+            name = (await bot.fetch_user(id)).display_name
+    except discord.HTTPException:
+        name = ''
+    mention_cache.put((kind, id), name)
+    return name
+
+
+async def modify_text(message:discord.Message, guild_conf:GuildConf, bot:commands.Bot) -> str:
     text = message.content
     text = text.replace('\n', '．')
-    #メンションを置き換え
-    match = user_mention_pattern.findall(text)
-    for user_id in match:
-        user = await bot.fetch_user(int(user_id))
-        text = re.sub(f'<@!?{user_id}>', user.display_name, text)
-    match = role_mention_pattern.findall(text)
-    for role_id in match:
-        role = message.guild.get_role(int(role_id))
-        text = re.sub(f'<@&{role_id}>', role.name, text)
-    match = channel_mention_pattern.findall(text)
-    for channel_id in match:
-        channel = await bot.fetch_channel(int(channel_id))
-        text = re.sub(f'<#{channel_id}>', channel.name, text)
-    #特殊パターンと絵文字を削除
-    text = special_pattern.sub('', text)
-    text = demoji.replace(text, '')
-    #特定の文字列を置換
-    text = url_pattern.sub('，URL，', text)
-    text = www_pattern.sub('，藁．', text)
+    #メンションを1回の走査でまとめて置き換え
+    names = {}
+    for kind, id in set(mention_pattern.findall(text)):
+        kind = '@' if kind == '@!' else kind
+        if (kind, id) not in names:
+            names[(kind, id)] = await mention_name(kind, int(id), message, bot)
+    def replace_mention(match:re.Match) -> str:
+        kind = '@' if match[1] == '@!' else match[1]
+        return names[(kind, match[2])] or match[0]
+    text = mention_pattern.sub(replace_mention, text)
+    #特殊パターンと絵文字を削除し，URLと末尾の笑いを置換
+    text = replace_tokens(text)
     #送信者名読み上げ
-    if guild_conf['read_author'] and text != '':
+    if guild_conf.read_author and text != '':
         text = f'{message.author.display_name}です，{text}'
     return text
 
 
-def preprocess_for_embed(old:dict, new:Union[dict, None]) -> dict:
-    _old = deepcopy(old)
-    _new = deepcopy(new)
+sentence_pattern = re.compile(r'[^．。！？]*[．。！？]+|[^．。！？]+$')
+clause_pattern = re.compile(r'[^，]*，+|[^，]+$')
+
+def truncate_text(text:str, max_chars:int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + '，以下略．'
+
+
+def split_sentences(text:str, chunk_len:int=50) -> List[str]:
+    chunks = []
+    for sentence in sentence_pattern.findall(text):
+        #長い文は読点でも区切る
+        pieces = [sentence] if len(sentence) <= chunk_len else clause_pattern.findall(sentence)
+        for piece in pieces:
+            #句読点のない長い部分は機械的に区切る
+            for i in range(0, len(piece), chunk_len):
+                part = piece[i:i + chunk_len]
+                #最初の1文はすぐに再生を始められるよう単独にし，以降は短いものをまとめる
+                if (len(chunks) >= 2) and (len(chunks[-1]) + len(part) <= chunk_len):
+                    chunks[-1] += part
+                else:
+                    chunks.append(part)
+    return chunks
+
+
+def preprocess_for_embed(old:Union[UserConf, GuildConf], new:Union[UserConf, GuildConf, None]) -> dict:
+    _old = old._asdict()
+    _new = None if new is None else new._asdict()
     if new is None:
         for key in _old.keys():
             #表示用に書き換え
@@ -91,7 +306,7 @@ def preprocess_for_embed(old:dict, new:Union[dict, None]) -> dict:
         return _old
     else:
         product = {}
-        for key in old.keys():
+        for key in old._fields:
             #表示用に書き換え
             if key == 'prefix':
                 _old['prefix'] = f"「{_old['prefix']}」"
@@ -99,7 +314,7 @@ def preprocess_for_embed(old:dict, new:Union[dict, None]) -> dict:
             elif key == 'target_ch':
                 _old['target_ch'] = f"<#{_old['target_ch']}>" if _old['target_ch'] != 'all' else 'all'
                 _new['target_ch'] = f"<#{_new['target_ch']}>" if _new['target_ch'] != 'all' else 'all'
-            elif isinstance(old[key], bool):
+            elif isinstance(_old[key], bool):
                 _old[key] = 'on' if _old[key] else 'off'
                 _new[key] = 'on' if _new[key] else 'off'
             #異なれば矢印でつなぐ
@@ -107,7 +322,7 @@ def preprocess_for_embed(old:dict, new:Union[dict, None]) -> dict:
         return product
 
 
-def conf_embed(obj:Union[discord.Member, discord.Guild], old_conf:dict, new_conf:Union[dict, None]) -> discord.Embed:
+def conf_embed(obj:Union[discord.Member, discord.Guild], old_conf:Union[UserConf, GuildConf], new_conf:Union[UserConf, GuildConf, None]) -> discord.Embed:
     preprocessed = preprocess_for_embed(old_conf, new_conf)
     if isinstance(obj, discord.Member):
         embed = discord.Embed(
@@ -131,7 +346,8 @@ def conf_embed(obj:Union[discord.Member, discord.Guild], old_conf:dict, new_conf
                 f'**自動入室　　　　**：{preprocessed["auto_join"]}\n' \
                 f'**入退室読み上げ　**：{preprocessed["read_access"]}\n' \
                 f'**送信者名読み上げ**：{preprocessed["read_author"]}\n' \
-                f'**非参加者読み上げ**：{preprocessed["read_outsider"]}'
+                f'**非参加者読み上げ**：{preprocessed["read_outsider"]}\n' \
+                f'**最大文字数　　　**：{preprocessed["max_chars"]}'
         )
         embed.set_thumbnail(url=obj.icon_url)
     return embed
@@ -192,7 +408,8 @@ def help_embed(prefix:str, option:Literal['voice', 'setting']=None) -> discord.E
                 f'{prefix}auto_join on/off：自動入室を変更する．\n' \
                 f'{prefix}read_access on/off：入退室読み上げを変更する．\n' \
                 f'{prefix}read_author on/off：送信者名読み上げを変更する．\n' \
-                f'{prefix}read_outsider on/off：非参加者読み上げを変更する．\n\n' \
+                f'{prefix}read_outsider on/off：非参加者読み上げを変更する．\n' \
+                f'{prefix}max_chars ＿：読み上げる最大文字数を＿に変更する．\n\n' \
         )
     return embed
 